@@ -1,10 +1,17 @@
 import gymnasium as gym
 import table_server
-from table_server.envs import TableServerModel
+from table_server.envs import TableServerModel, TableServerState
+from table_server.envs.table_server_model import (ActionIndex, AreaIndex, PlayerIndex, MOVES, layout_key,
+                                                  packed_state)
 from gym import envs
-from queue import Queue, LifoQueue, PriorityQueue
+import argparse
+import heapq
+import json
+import multiprocessing
 import numpy as np
-from time import time
+import sqlite3
+from collections import OrderedDict
+from time import time, perf_counter
 from enum import IntEnum
 
 
@@ -12,6 +19,10 @@ class Search(IntEnum):
     A_STAR = 0
     GREEDY_BEST_FIRST_SEARCH = 1
     UNIFORM_COST_SEARCH = 2
+    IDA_STAR = 3
+    BEAM_SEARCH = 4
+    SMA_STAR = 5
+    HIERARCHICAL = 6
 
 
 class Goal(IntEnum):
@@ -20,6 +31,30 @@ class Goal(IntEnum):
     THIRD = 2
 
 
+def order_progress(model, state):
+    """
+    (held meal, meals left in the kitchen, tables served) of any state model takes
+    """
+    if isinstance(state, (int, np.integer)):
+        state = getattr(model, "STATE", packed_state)(state)
+    if type(state) != dict:
+        state = state.order
+    return (int(state["playerStatus"]), state["kitchen_meals"].size,
+            int(state["table_status"].sum()))
+
+
+def a_star_priority(path_cost, heuristic):
+    return path_cost + heuristic, heuristic
+
+
+def greedy_best_first_priority(path_cost, heuristic):
+    return heuristic, path_cost
+
+
+def uniform_cost_priority(path_cost, heuristic):
+    return path_cost, heuristic
+
+
 class StateNode:
     def __init__(self, state, parent, action, depth, path_cost, heuristic):
         self.state = state
@@ -47,6 +82,155 @@ class StateNode:
         return self.path_cost + self.heuristic
 
 
+class SearchStats:
+    """
+    Counters and timings one search fills in, times are in seconds
+    """
+
+    def __init__(self):
+        self.expanded = 0
+        self.generated = 0
+        self.reopened = 0
+        self.duplicates = 0
+        self.stale = 0
+        self.peak_frontier = 0
+        self.reached = 0
+        self.successor_time = 0.0
+        self.hash_time = 0.0
+        self.heuristic_time = 0.0
+        self.queue_time = 0.0
+        self.total_time = 0.0
+        # nodes held at once, against the budget of the memory-bounded searches
+        self.peak_nodes = 0
+        self.node_budget = None
+
+    def finish(self, reached, total_time, peak_nodes=None):
+        self.reached = reached
+        self.total_time = total_time
+        self.peak_nodes = reached if peak_nodes is None else peak_nodes
+
+    def add(self, other):
+        """
+        Fold the counters of a sub-search into these
+        """
+        for name in ["expanded", "generated", "reopened", "duplicates", "stale", "reached",
+                     "successor_time", "hash_time", "heuristic_time", "queue_time"]:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.peak_frontier = max(self.peak_frontier, other.peak_frontier)
+        self.peak_nodes = max(self.peak_nodes, other.peak_nodes)
+
+    def budget_used(self):
+        """
+        Fraction of the node budget the search needed at its peak
+        """
+        if not self.node_budget:
+            return None
+        return self.peak_nodes / self.node_budget
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class PlanCache:
+    """
+    Plans keyed by (start configuration, search, goal test), the most recently
+    used maxsize kept in memory and, when path is given, every plan kept in
+    an sqlite file that later runs and other processes read
+    """
+
+    def __init__(self, maxsize=1024, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=30)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS plans (key TEXT PRIMARY KEY, plan TEXT)")
+            self._db.commit()
+
+    def key(self, start, search, goal, model=None):
+        """
+        The packed start state only places the server and tables, the layout
+        key adds the walls and kitchen so layouts of one size never share plans.
+        FIRST and SECOND count orders from a start the packed state does not
+        keep, so their keys add the queued meals and served tables counted
+        from. Packed ints are read by model.STATE, on the default layout
+        without one.
+        """
+        if isinstance(start, (int, np.integer)):
+            state = getattr(model, "STATE", packed_state)(start)
+            prefix = state.layout.key
+            counts = state._start_queued, state._start_served
+        elif type(start) == dict:
+            area = start["area"]
+            kitchen = np.flatnonzero(area.ravel() == AreaIndex.KITCHEN)
+            if kitchen.size == 0:
+                # the kitchen is hidden under the server
+                kitchen = np.flatnonzero(area.ravel() == AreaIndex.SERVER)
+            prefix = layout_key(area == AreaIndex.WALL, divmod(int(kitchen[0]), area.shape[1]))
+            counts = start["kitchen_meals"].size, int(start["table_status"].sum())
+        else:
+            prefix = start.layout.key
+            counts = start._start_queued, start._start_served
+        key = "{}:{}:{}:{}".format(prefix, TableServerModel.ENCODE(start), search, goal)
+        if goal in (Goal.FIRST.name, Goal.SECOND.name):
+            key += ":{}.{}".format(*counts)
+        return key
+
+    def get(self, key):
+        if key in self._plans:
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return self._plans[key]
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT plan FROM plans WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self._remember(key, json.loads(row[0]))
+                return self._plans[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, plan):
+        plan = [int(action) for action in plan]
+        self._remember(key, plan)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO plans VALUES (?, ?)",
+                             (key, json.dumps(plan)))
+            self._db.commit()
+
+    def _remember(self, key, plan):
+        self._plans[key] = plan
+        self._plans.move_to_end(key)
+        if len(self._plans) > self.maxsize:
+            self._plans.popitem(last=False)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class MemoryNode(StateNode):
+    """
+    StateNode of SMA*, with the backed up f of its forgotten children
+    """
+
+    def __init__(self, state, parent, action, depth, path_cost, heuristic, hash):
+        super().__init__(state, parent, action, depth, path_cost, heuristic)
+        self.hash = hash
+        self.f = path_cost + heuristic
+        if parent is not None:
+            self.f = max(self.f, parent.f)
+        self.children = 0
+        self.forgotten = float("inf")
+        self.entry = None
+
+
 class Score:
     def __init__(self):
         self.best_score = float('-inf')
@@ -86,159 +270,498 @@ class Score:
 
 
 class Agent:
-    def __init__(self, model, use_gui=False):
+    def __init__(self, model, use_gui=False, stats_path=None, plan_cache=None, node_budget=100000, beam_width=32,
+                 env_options=None, record_path=None):
         self.model = model
+        # keyword arguments of the env, like height, width, tables and layout_seed
+        self.env_options = env_options or {}
+        # limits of the memory-bounded searches
+        self.node_budget = node_budget
+        self.beam_width = beam_width
+        # append one JSON line of SearchStats per episode when set
+        self.stats_path = stats_path
+        # skip the search for start configurations solved before when set
+        self.plan_cache = plan_cache
         # self.env = gym.make('table_server/TableServer-v0', render_mode="human")
         if use_gui:
             self.env = gym.make(
-                'table_server/TableServer-v0', render_mode="human")
+                'table_server/TableServer-v0', render_mode="human", **self.env_options)
         else:
             self.env = gym.make(
-                'table_server/TableServer-v0', render_mode=None)
+                'table_server/TableServer-v0', render_mode=None, **self.env_options)
+        # append every played episode to this log when set, see TableServerReplay
+        self.record_path = record_path
+        if record_path is not None:
+            self.env = table_server.TableServerRecorder(self.env, record_path)
         self.total_score = Score()
         self.SEARCHES = [self.a_star_search,
-                         self.greedy_best_first_search, self.uniform_cost_search]
+                         self.greedy_best_first_search, self.uniform_cost_search,
+                         self.ida_star_search, self.beam_search, self.sma_star_search,
+                         self.hierarchical_search]
         self.GOALS = [self.model.FIRST_GOAL_TEST,
                       self.model.SECOND_GOAL_TEST, self.model.GOAL_TEST]
 
     def hash_observation(self, observation):
-        return hash(str(observation))
-
-    def a_star_search(self, initial_state, model=TableServerModel):
-        # print("Initial state:", initial_state)
+        return self.model.ENCODE(observation)
+
+    def best_first_search(self, initial_state, priority, model=TableServerModel, stats=None, goal_test=None):
+        """
+        Graph search ordered by priority(path_cost, heuristic) -> (f, tie).
+        Heap entries are (f, tie, counter, hash, node), entries whose node is
+        no longer the best one reached for its state are skipped when popped.
+        Pass a SearchStats as stats to have it filled in, without one
+        nothing is counted or timed. goal_test defaults to model.GOAL_TEST.
+        """
+        if goal_test is None:
+            goal_test = model.GOAL_TEST
         reached = {}
-        queue = PriorityQueue()
-
-        node = StateNode(initial_state, None, None, 0, 0,
-                         model.HEURISTIC(initial_state))
-        first_hash = self.hash_observation(initial_state)
-        reached[first_hash] = node
-
-        queue.put(node)
-
-        while queue.qsize() > 0:
-            # print(queue.qsize(), "Popped a node")
-            # print(queue.qsize())
-            node = queue.get()
-
-            # print("Goal test")
-            if model.GOAL_TEST(node.state):
+        frontier = []
+        counter = 0
+        if stats is not None:
+            search_start = perf_counter()
+
+        heuristic = model.HEURISTIC(initial_state)
+        node = StateNode(initial_state, None, None, 0, 0, heuristic)
+        hash = self.hash_observation(initial_state)
+        reached[hash] = node
+        heapq.heappush(frontier, (*priority(0, heuristic), counter, hash, node))
+
+        while frontier:
+            if stats is not None:
+                stats.peak_frontier = max(stats.peak_frontier, len(frontier))
+                start = perf_counter()
+            *_, hash, node = heapq.heappop(frontier)
+            if stats is not None:
+                stats.queue_time += perf_counter() - start
+            if reached[hash] is not node:
+                if stats is not None:
+                    stats.stale += 1
+                continue
+
+            if goal_test(node.state):
+                if stats is not None:
+                    stats.finish(len(reached), perf_counter() - search_start)
                 return node, True
+            if stats is not None:
+                stats.expanded += 1
 
             for action in model.ACTIONS(node.state):
-                # print("Generating a successor")
-                # print(action)
+                if stats is not None:
+                    start = perf_counter()
                 state_prime = model.RESULT(node.state, action)
+                path_cost = node.path_cost + \
+                    model.STEP_COST(node.state, action, state_prime)
+                if stats is not None:
+                    stats.generated += 1
+                    stats.successor_time += perf_counter() - start
+                    start = perf_counter()
                 hash = self.hash_observation(state_prime)
-
-                if hash not in reached or reached[hash].path_cost > node.path_cost + model.STEP_COST(node.state, action, state_prime):
-
-                    # print("Successor not in reached or has a lower path cost")
+                if stats is not None:
+                    stats.hash_time += perf_counter() - start
+
+                if hash not in reached or reached[hash].path_cost > path_cost:
+                    if stats is not None:
+                        stats.reopened += hash in reached
+                        start = perf_counter()
+                    heuristic = model.HEURISTIC(state_prime)
+                    if stats is not None:
+                        stats.heuristic_time += perf_counter() - start
+                        start = perf_counter()
                     new_node = StateNode(state_prime, node, action, node.depth + 1,
-                                         node.path_cost + model.STEP_COST(node.state, action, state_prime), model.HEURISTIC(state_prime))
-
-                    # print("Adding a node to the queue")
-                    queue.put(new_node)
-                    # print("Reached:", len(reached))
+                                         path_cost, heuristic)
                     reached[hash] = new_node
-
+                    counter += 1
+                    heapq.heappush(
+                        frontier, (*priority(path_cost, heuristic), counter, hash, new_node))
+                    if stats is not None:
+                        stats.queue_time += perf_counter() - start
+                elif stats is not None:
+                    stats.duplicates += 1
+
+        if stats is not None:
+            stats.finish(len(reached), perf_counter() - search_start)
         return None, False
 
-    def greedy_best_first_search(self, initial_state, model=TableServerModel):
-        # print("Greedy best first search")
-        reached = {}
-        queue = PriorityQueue()
-
-        node = StateNode(initial_state, None, None, 0, 0,
+    def a_star_search(self, initial_state, model=TableServerModel, stats=None, goal_test=None):
+        return self.best_first_search(initial_state, a_star_priority, model, stats, goal_test)
+
+    def greedy_best_first_search(self, initial_state, model=TableServerModel, stats=None, goal_test=None):
+        return self.best_first_search(initial_state, greedy_best_first_priority, model, stats, goal_test)
+
+    def uniform_cost_search(self, initial_state, model=TableServerModel, stats=None, goal_test=None):
+        return self.best_first_search(initial_state, uniform_cost_priority, model, stats, goal_test)
+
+    def ida_star_search(self, initial_state, model=TableServerModel, stats=None, goal_test=None):
+        """
+        Depth first searches cut off at f = g + h above a bound, the bound
+        raised to the lowest f that was cut off until a goal is found. Only
+        the current path is kept and it may not hold more than node_budget
+        nodes.
+        """
+        if goal_test is None:
+            goal_test = model.GOAL_TEST
+        if stats is not None:
+            search_start = perf_counter()
+            stats.node_budget = self.node_budget
+        peak = 1
+
+        root = StateNode(initial_state, None, None, 0, 0,
                          model.HEURISTIC(initial_state))
-        first_hash = self.hash_observation(initial_state)
-        reached[first_hash] = node
-
-        queue.put(node)
+        root_hash = self.hash_observation(initial_state)
+        bound = root.heuristic
+        result = None, False
+
+        if goal_test(initial_state):
+            result = root, True
+        while result[1] is False and bound < float("inf"):
+            next_bound = float("inf")
+            path = {root_hash}
+            stack = [(root, root_hash, iter(model.ACTIONS(initial_state)))]
+            while stack:
+                node, hash, actions = stack[-1]
+                action = next(actions, None)
+                if action is None:
+                    stack.pop()
+                    path.discard(hash)
+                    continue
 
-        while queue.qsize() > 0:
-            # print(queue.qsize(), "Popped a node")
-            node = queue.get()
-
-            # print("Goal test")
-            if model.GOAL_TEST(node.state):
-                return node, True
-
-            for action in model.ACTIONS(node.state):
-                # print("Generating a successor")
-                # print(action)
                 state_prime = model.RESULT(node.state, action)
                 hash = self.hash_observation(state_prime)
-
-                if hash not in reached or reached[hash].heuristic > model.HEURISTIC(state_prime):
-
-                    # print("Successor not in reached or has a lower path cost")
-                    new_node = StateNode(state_prime, node, action, node.depth + 1,
-                                         node.path_cost + model.STEP_COST(node.state, action, state_prime), model.HEURISTIC(state_prime))
-
-                    # print("Adding a node to the queue")
-                    queue.put(new_node)
-                    reached[hash] = new_node
-
-        return None, False
-
-    def uniform_cost_search(self, initial_state, model=TableServerModel):
-        # print("Uniform cost search")
-        reached = {}
-        queue = PriorityQueue()
-
-        node = StateNode(initial_state, None, None, 0, 0,
+                if stats is not None:
+                    stats.generated += 1
+                if hash in path:
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
+                path_cost = node.path_cost + \
+                    model.STEP_COST(node.state, action, state_prime)
+                heuristic = model.HEURISTIC(state_prime)
+                if path_cost + heuristic > bound:
+                    next_bound = min(next_bound, path_cost + heuristic)
+                    continue
+
+                child = StateNode(state_prime, node, action, node.depth + 1,
+                                  path_cost, heuristic)
+                if goal_test(state_prime):
+                    result = child, True
+                    break
+                if len(stack) >= self.node_budget:
+                    # the path would go over the budget
+                    next_bound = float("inf")
+                    break
+                stack.append((child, hash, iter(model.ACTIONS(state_prime))))
+                path.add(hash)
+                peak = max(peak, len(stack))
+                if stats is not None:
+                    stats.expanded += 1
+            bound = next_bound
+
+        if stats is not None:
+            stats.finish(peak, perf_counter() - search_start, peak)
+        return result
+
+    def beam_search(self, initial_state, model=TableServerModel, stats=None, goal_test=None):
+        """
+        Breadth first by depth, keeping only the beam_width nodes with the
+        lowest f = g + h at each depth. Every kept layer stays in memory
+        through the parent links, the search stops before the kept nodes go
+        over node_budget.
+        """
+        if goal_test is None:
+            goal_test = model.GOAL_TEST
+        if stats is not None:
+            search_start = perf_counter()
+            stats.node_budget = self.node_budget
+
+        root = StateNode(initial_state, None, None, 0, 0,
                          model.HEURISTIC(initial_state))
-        first_hash = self.hash_observation(initial_state)
-        reached[first_hash] = node
-
-        queue.put(node)
-
-        while queue.qsize() > 0:
-            # print(queue.qsize(), "Popped a node")
-            node = queue.get()
-
-            # print("Goal test")
-            if model.GOAL_TEST(node.state):
-                return node, True
-
-            for action in model.ACTIONS(node.state):
-                # print("Generating a successor")
-                # print(action)
+        layer = [root]
+        kept = 1
+        # best path cost of every kept state, so the beam does not walk in circles
+        seen = {self.hash_observation(initial_state): 0}
+        result = None, False
+
+        while layer:
+            goals = [node for node in layer if goal_test(node.state)]
+            if goals:
+                result = goals[0], True
+                break
+
+            successors = {}
+            for node in layer:
+                if stats is not None:
+                    stats.expanded += 1
+                for action in model.ACTIONS(node.state):
+                    state_prime = model.RESULT(node.state, action)
+                    hash = self.hash_observation(state_prime)
+                    path_cost = node.path_cost + \
+                        model.STEP_COST(node.state, action, state_prime)
+                    if stats is not None:
+                        stats.generated += 1
+                    if seen.get(hash, path_cost + 1) <= path_cost or \
+                            (hash in successors and successors[hash].path_cost <= path_cost):
+                        if stats is not None:
+                            stats.duplicates += 1
+                        continue
+                    successors[hash] = StateNode(state_prime, node, action, node.depth + 1,
+                                                 path_cost, model.HEURISTIC(state_prime))
+
+            layer = heapq.nsmallest(self.beam_width, successors.values(),
+                                    key=lambda node: (node.path_cost + node.heuristic, node.heuristic))
+            if stats is not None:
+                stats.peak_frontier = max(stats.peak_frontier, len(successors))
+            if kept + len(layer) > self.node_budget:
+                break
+            kept += len(layer)
+            for node in layer:
+                seen[self.hash_observation(node.state)] = node.path_cost
+
+        if stats is not None:
+            stats.finish(kept, perf_counter() - search_start, kept)
+        return result
+
+    def sma_star_search(self, initial_state, model=TableServerModel, stats=None, goal_test=None):
+        """
+        Simplified memory-bounded A*. Expands the leaf with the lowest f like
+        A*, but holds at most node_budget nodes. When memory is full the leaf
+        with the highest f is forgotten and its f is backed up into its
+        parent, which becomes a leaf again once all its children are gone.
+        """
+        if goal_test is None:
+            goal_test = model.GOAL_TEST
+        if stats is not None:
+            search_start = perf_counter()
+            stats.node_budget = self.node_budget
+
+        # best leaves: lowest f, deepest first. worst leaves: highest f, shallowest first
+        best, worst = [], []
+        counter = 0
+        memory = 0
+        in_memory = {}
+
+        def open_leaf(node):
+            nonlocal counter
+            counter += 1
+            node.entry = counter
+            heapq.heappush(best, (node.f, -node.depth, counter, node))
+            heapq.heappush(worst, (-node.f, node.depth, counter, node))
+
+        def pop_leaf(heap):
+            while heap:
+                *_, entry, node = heapq.heappop(heap)
+                if node.entry == entry and (heap is best or node.parent is not None):
+                    node.entry = None
+                    return node
+            return None
+
+        def forget(leaf):
+            nonlocal memory
+            memory -= 1
+            if in_memory.get(leaf.hash) is leaf:
+                del in_memory[leaf.hash]
+            parent = leaf.parent
+            parent.children -= 1
+            parent.forgotten = min(parent.forgotten, leaf.f)
+            if parent.children == 0:
+                parent.f = parent.forgotten
+                parent.forgotten = float("inf")
+                open_leaf(parent)
+
+        root = MemoryNode(initial_state, None, None, 0, 0,
+                          model.HEURISTIC(initial_state), self.hash_observation(initial_state))
+        in_memory[root.hash] = root
+        memory = peak = 1
+        open_leaf(root)
+        result = None, False
+
+        while True:
+            node = pop_leaf(best)
+            if node is None or node.f == float("inf"):
+                break
+            if goal_test(node.state):
+                result = node, True
+                break
+            if stats is not None:
+                stats.expanded += 1
+
+            # make room for every successor before generating them
+            actions = model.ACTIONS(node.state)
+            while memory + len(actions) > self.node_budget:
+                leaf = pop_leaf(worst)
+                if leaf is None:
+                    break
+                forget(leaf)
+            if memory + len(actions) > self.node_budget:
+                break
+
+            for action in actions:
                 state_prime = model.RESULT(node.state, action)
                 hash = self.hash_observation(state_prime)
+                path_cost = node.path_cost + \
+                    model.STEP_COST(node.state, action, state_prime)
+                if stats is not None:
+                    stats.generated += 1
+                if hash in in_memory and in_memory[hash].path_cost <= path_cost:
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
+                child = MemoryNode(state_prime, node, action, node.depth + 1,
+                                   path_cost, model.HEURISTIC(state_prime), hash)
+                # a path this deep can not be extended within the budget
+                if child.depth >= self.node_budget - 1 and not goal_test(state_prime):
+                    child.f = float("inf")
+                in_memory[hash] = child
+                node.children += 1
+                memory += 1
+                open_leaf(child)
+            peak = max(peak, memory)
+
+            if node.children == 0:
+                # every successor is in memory on a path at least as cheap
+                node.f = float("inf")
+                if node.parent is None:
+                    break
+                forget(node)
+
+        if stats is not None:
+            stats.finish(memory, perf_counter() - search_start, peak)
+        return result
+
+    def hierarchical_search(self, initial_state, model=TableServerModel, stats=None, goal_test=None):
+        """
+        Solve the order one leg at a time without searching: a walk to the
+        kitchen and a pick up, or a walk to the table of the held meal and a
+        serve. A walk steps down the distance map of its target, which the
+        layout keeps for every later episode, so each leg is a route lookup.
+        With the queue order fixed the joined path is as short as the one a
+        full A* finds, see optimality_gap.
+        """
+        if goal_test is None:
+            goal_test = model.GOAL_TEST
+        if stats is not None:
+            search_start = perf_counter()
+        if type(initial_state) == dict:
+            initial_state = TableServerState.from_observation(initial_state)
+
+        node = StateNode(initial_state, None, None, 0, 0, 0)
+        solved = True
+        while solved and not goal_test(node.state):
+            state = node.state
+            if isinstance(state, (int, np.integer)):
+                state = getattr(model, "STATE", packed_state)(state)
+            if state._playerStatus != PlayerIndex.NONE.value:
+                target = state._table_spawns[state._playerStatus - 1]
+                last = ActionIndex.SERVE_MEAL
+            elif state._kitchen_meals.size > 0:
+                target = state._kitchen_pos
+                last = ActionIndex.PICK_UP_MEAL
+            else:
+                solved = False
+                break
+
+            distances = state._distances.distances_from(*target)
+            height, width = distances.shape
+            row, col = state._player_pos
+            if distances[row, col] < 0:
+                solved = False
+                break
+            leg = []
+            while distances[row, col] > 0:
+                for action, (move_row, move_col) in MOVES.items():
+                    next_row, next_col = row + move_row, col + move_col
+                    if 0 <= next_row < height and 0 <= next_col < width and \
+                            distances[next_row, next_col] == distances[row, col] - 1:
+                        break
+                leg.append(action)
+                row, col = next_row, next_col
+            leg.append(last)
+
+            for action in leg:
+                state_prime = model.RESULT(node.state, action)
+                node = StateNode(state_prime, node, action, node.depth + 1,
+                                 node.path_cost + model.STEP_COST(node.state, action, state_prime), 0)
+                if stats is not None:
+                    stats.expanded += 1
+                    stats.generated += 1
+                # the goal can be reached halfway through a leg
+                if goal_test(node.state):
+                    break
+
+        if stats is not None:
+            stats.finish(node.depth + 1, perf_counter() - search_start)
+        return (node, True) if solved else (None, False)
+
+    def optimality_gap(self, times, search=Search.HIERARCHICAL, baseline=Search.A_STAR, seed=None):
+        """
+        Plan the same times start configurations with search and baseline
+        and print how much longer and how much faster search is
+        """
+        costs = np.zeros((times, 2))
+        times_taken = np.zeros((times, 2))
+        for i, episode_seed in enumerate(episode_seeds(times, seed)):
+            observation, _ = self.env.reset(seed=episode_seed)
+            for j, which in enumerate([search, baseline]):
+                start = perf_counter()
+                node, solved = self.SEARCHES[which](observation, self.model)
+                times_taken[i, j] = perf_counter() - start
+                costs[i, j] = node.path_cost if solved else np.nan
+
+        gap = costs[:, 0] - costs[:, 1]
+        print("SEARCH:", Search(search).name, "vs", Search(baseline).name)
+        print("Average cost:", round(np.nanmean(costs[:, 0]), 2),
+              "vs", round(np.nanmean(costs[:, 1]), 2))
+        print("Average gap:", round(np.nanmean(gap), 2),
+              "(" + str(round(100 * np.nanmean(gap / costs[:, 1]), 2)) + " %)")
+        print("Largest gap:", np.nanmax(gap))
+        print("Average time:", str(round(times_taken[:, 0].mean() * 1000, 2)) + " ms",
+              "vs", str(round(times_taken[:, 1].mean() * 1000, 2)) + " ms")
+        return costs, times_taken
+
+    def plan(self, observation, search=Search.A_STAR, goal=Goal.THIRD, seed=None):
+        """
+        Actions that reach goal from observation with search, and whether
+        the search solved it. Cached plans are returned without searching.
+        """
+        if self.plan_cache is not None:
+            key = self.plan_cache.key(
+                observation, Search(search).name, Goal(goal).name, self.model)
+            path = self.plan_cache.get(key)
+            if path is not None:
+                return path, True
+
+        goal_test = self.GOALS[goal]
+        if self.stats_path is None:
+            node, solved = self.SEARCHES[search](
+                observation, self.model, goal_test=goal_test)
+        else:
+            stats = SearchStats()
+            node, solved = self.SEARCHES[search](
+                observation, self.model, stats, goal_test)
+            with open(self.stats_path, "a") as f:
+                f.write(json.dumps({"search": Search(search).name, "seed": seed, "solved": solved,
+                                    "stats": stats.to_dict()}) + "\n")
+        if not solved:
+            return None, False
 
-                if hash not in reached or reached[hash].path_cost > node.path_cost + model.STEP_COST(node.state, action, state_prime):
-
-                    # print("Successor not in reached or has a lower path cost")
-                    new_node = StateNode(state_prime, node, action, node.depth + 1,
-                                         node.path_cost + model.STEP_COST(node.state, action, state_prime), model.HEURISTIC(state_prime))
-
-                    # print("Adding a node to the queue")
-                    queue.put(new_node)
-                    reached[hash] = new_node
-
-        return None, False
+        path = node.get_path()
+        if self.plan_cache is not None:
+            self.plan_cache.put(key, path)
+        return path, True
 
-    def run_agent(self, search=Search.A_STAR, run_many_times=False):
+    def run_agent(self, search=Search.A_STAR, run_many_times=False, seed=None):
         startTime = time()
-        observation, _ = self.env.reset()
+        # an unseeded episode continues the generator of the env
+        observation, _ = self.env.reset(seed=seed)
         self.env.render()
         # print(observation)
 
-        search = self.SEARCHES[search]
+        path, solved = self.plan(observation, search, seed=seed)
 
-        node, solved = search(observation, self.model)
-
-        if not solved and node is None:
-            if not solved:
-                print("Not solved")
-            if node is None:
-                print("Node is None")
+        if not solved:
+            print("Not solved")
             print("Failed")
-            return 0
+            return 0, time() - startTime, False
 
-        path = node.get_path()
         total_reward = 0
 
         for action in path:
@@ -252,15 +775,25 @@ class Agent:
         # print(observation)
 
         total_time = time() - startTime
-        self.total_score.update(total_reward, 0)
-        return total_reward, total_time
+        return total_reward, total_time, True
 
-    def run_many_times(self, times, search=Search.A_STAR):
+    def run_many_times(self, times, search=Search.A_STAR, workers=1, seed=None):
         total_score = 0
         total_time = 0
         attempts = 0
-        for i in range(times):
-            score, time = self.run_agent(search, True)
+        seeds = episode_seeds(times, seed)
+        if workers > 1:
+            results = self.run_parallel(search, seeds, workers)
+        else:
+            results = (self.run_agent(search, True, episode_seed)
+                       for episode_seed in seeds)
+        failed = 0
+        for i, (score, time, solved) in enumerate(results):
+            # failed episodes have no score, whichever process ran them
+            if solved:
+                self.total_score.update(score, 0)
+            else:
+                failed += 1
             total_score += score
             total_time += time
             attempts += 1
@@ -275,21 +808,134 @@ class Agent:
             if i == 5000:
                 print("5000 runs")
         print("SEARCH:", search)
-        print("Highest score:", self.total_score.best_score)
-        print("Lowest score:", self.total_score.worst_score)
-        print("Average score:", round(self.total_score.get_average(), 2))
-        print("Average time:", str(round(total_time / times, 2)) + " s")
+        if self.total_score.runs > 0:
+            print("Highest score:", self.total_score.best_score)
+            print("Lowest score:", self.total_score.worst_score)
+            print("Average score:", round(self.total_score.get_average(), 2))
+        print("Failed:", failed, "of", attempts)
+        if attempts > 0:
+            print("Average time:", str(round(total_time / attempts, 2)) + " s")
         self.total_score.reset()
         total_score = 0
         total_time = 0
         attempts = 0
 
-    def run_all_searches(self, times):
+    def run_parallel(self, search, seeds, workers):
+        """
+        Yield (score, time, solved) of one episode per seed, in seed order, from a
+        pool of workers that each own an env
+        """
+        chunksize = max(1, len(seeds) // (workers * 4))
+        cache = None
+        if self.plan_cache is not None:
+            cache = (self.plan_cache.maxsize, self.plan_cache.path)
+        options = (self.model, self.stats_path, cache,
+                   self.node_budget, self.beam_width, self.env_options, self.record_path)
+        with multiprocessing.Pool(workers, _init_worker, options) as pool:
+            tasks = [(search, episode_seed) for episode_seed in seeds]
+            yield from pool.imap(_run_episode, tasks, chunksize)
+
+    def run_all_searches(self, times, workers=1, seed=None):
         for search in Search:
-            self.run_many_times(times, search)
-
-
-run_times = 5000
-agent = Agent(TableServerModel, True)
-# agent.run_all_searches(run_times)
-agent.run_agent(Search.A_STAR)
+            self.run_many_times(times, search, workers, seed)
+
+
+def episode_seeds(times, seed=None):
+    """
+    One independent seed per episode, so results do not depend on how
+    episodes are split between workers
+    """
+    if seed is None:
+        return [None] * times
+    return [int(child.generate_state(1)[0])
+            for child in np.random.SeedSequence(seed).spawn(times)]
+
+
+# every pool worker builds its own agent and env once
+_worker_agent = None
+
+
+def _init_worker(model, stats_path, cache, node_budget, beam_width, env_options, record_path):
+    global _worker_agent
+    plan_cache = None if cache is None else PlanCache(*cache)
+    _worker_agent = Agent(model, False, stats_path, plan_cache,
+                          node_budget, beam_width, env_options, record_path)
+
+
+def _run_episode(task):
+    search, seed = task
+    return _worker_agent.run_agent(search, True, seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=None,
+                        help="run this many episodes per search instead of one episode with the gui")
+    parser.add_argument("--search", type=str, default=None, choices=[search.name for search in Search],
+                        help="only run this search, all searches are run by default with --runs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes for --runs")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed for the start configurations")
+    parser.add_argument("--stats", type=str, default=None,
+                        help="append search statistics of every episode to this JSON lines file")
+    parser.add_argument("--plan-cache", type=int, default=None, metavar="SIZE",
+                        help="reuse plans of start configurations solved before, keeping SIZE in memory")
+    parser.add_argument("--plan-store", type=str, default=None,
+                        help="sqlite file that keeps cached plans between runs")
+    parser.add_argument("--node-budget", type=int, default=100000,
+                        help="most nodes IDA_STAR, BEAM_SEARCH and SMA_STAR may hold")
+    parser.add_argument("--beam-width", type=int, default=32,
+                        help="nodes BEAM_SEARCH keeps per depth")
+    parser.add_argument("--layout", type=int, nargs=4, default=None,
+                        metavar=("HEIGHT", "WIDTH", "TABLES", "MEALS"),
+                        help="play on a generated layout of this size instead of the default one")
+    parser.add_argument("--layout-seed", type=int, default=None,
+                        help="seed of the generated layout")
+    parser.add_argument("--record", type=str, default=None,
+                        help="append every played episode to this binary log")
+    parser.add_argument("--export", type=str, default=None,
+                        help="after the runs, render the --record log to this .npy file or png directory")
+    parser.add_argument("--gap", action="store_true",
+                        help="with --runs, compare --search (HIERARCHICAL by default) against A_STAR")
+    args = parser.parse_args()
+    if args.export is not None and args.record is None:
+        parser.error("--export renders the episodes of --record")
+
+    plan_cache = None
+    if args.plan_cache is not None or args.plan_store is not None:
+        plan_cache = PlanCache(args.plan_cache or 1024, args.plan_store)
+
+    env_options = {}
+    if args.layout is not None:
+        height, width, tables, meals = args.layout
+        env_options = dict(height=height, width=width, tables=tables, meals=meals,
+                           max_episode_steps=height * width * (meals + 1))
+    if args.layout_seed is not None:
+        env_options["layout_seed"] = args.layout_seed
+
+    if args.runs is None:
+        agent = Agent(TableServerModel, True, args.stats, plan_cache,
+                      args.node_budget, args.beam_width, env_options, args.record)
+        agent.run_agent(Search[args.search or "A_STAR"], seed=args.seed)
+    else:
+        agent = Agent(TableServerModel, False, args.stats, plan_cache,
+                      args.node_budget, args.beam_width, env_options, args.record)
+        if args.gap:
+            agent.optimality_gap(args.runs, Search[args.search or "HIERARCHICAL"],
+                                 seed=args.seed)
+        elif args.search is None:
+            agent.run_all_searches(args.runs, args.workers, args.seed)
+        else:
+            agent.run_many_times(
+                args.runs, Search[args.search], args.workers, args.seed)
+
+    if args.export is not None:
+        agent.env.close()
+        replay = table_server.TableServerReplay(args.record)
+        exporter = table_server.TableServerExporter.from_replay(replay, workers=args.workers)
+        episodes = [replay.episode(i) for i in range(len(replay))]
+        if args.export.endswith(".npy"):
+            exporter.to_npy(episodes, args.export)
+        else:
+            exporter.to_images(episodes, args.export)
@@ -0,0 +1,356 @@
+"""
+Micro and macro benchmarks for the model, env and search hot paths.
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --baseline results.json
+
+Every benchmark reports ops/sec (nodes/sec for the searches) and peak
+traced memory. With --baseline the run is compared against a stored result
+file and any benchmark slower by more than --tolerance is flagged, the
+exit code is 1 when something regressed or when import table_server takes
+longer than --max-import-ms.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "table-server"))
+sys.path.insert(0, os.path.join(here, "..", "agents"))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from table_server.envs import TableServerEnv, TableServerModel, TableServerState  # noqa: E402
+from table_server.envs import TableServerRecorder, TableServerSubprocVectorEnv  # noqa: E402
+from table_server.envs.table_server_model import get_layout  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+# a generated restaurant for the "large" benchmarks
+LARGE = dict(height=100, width=100, tables=20, meals=20, layout_seed=0)
+
+
+def random_states(count, seed=0, **layout):
+    """
+    States met along seeded random walks, so every run times the same inputs
+    """
+    rng = np.random.default_rng(seed)
+    states = []
+    if layout:
+        layout = dict(layout)
+        layout["layout"] = get_layout(layout["height"], layout["width"],
+                                      layout["tables"], layout.pop("layout_seed"))
+    while len(states) < count:
+        state = TableServerState(**layout, rng=rng)
+        for _ in range(40):
+            states.append(state)
+            state = TableServerModel.RESULT(
+                state, rng.choice(TableServerModel.ACTIONS(state)))
+    return states[:count]
+
+
+class CountingModel:
+    """
+    TableServerModel that counts RESULT calls, i.e. generated nodes
+    """
+
+    def __init__(self, model=TableServerModel):
+        self.model = model
+        self.generated = 0
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def RESULT(self, state, action):
+        self.generated += 1
+        return self.model.RESULT(state, action)
+
+
+@benchmark("state.turn")
+def bench_turn(size):
+    states = [state.copy() for state in random_states(size)]
+    start = perf_counter()
+    for i, state in enumerate(states):
+        state.turn(i % 6)
+    return size, perf_counter() - start
+
+
+@benchmark("model.RESULT")
+def bench_result(size):
+    states = random_states(size)
+    start = perf_counter()
+    for i, state in enumerate(states):
+        TableServerModel.RESULT(state, i % 6)
+    return size, perf_counter() - start
+
+
+@benchmark("model.RESULT.large")
+def bench_result_large(size):
+    states = random_states(size, **LARGE)
+    start = perf_counter()
+    for i, state in enumerate(states):
+        TableServerModel.RESULT(state, i % 6)
+    return size, perf_counter() - start
+
+
+@benchmark("model.ACTIONS")
+def bench_actions(size):
+    states = random_states(size)
+    start = perf_counter()
+    for state in states:
+        TableServerModel.ACTIONS(state)
+    return size, perf_counter() - start
+
+
+@benchmark("model.HEURISTIC")
+def bench_heuristic(size):
+    states = random_states(size)
+    start = perf_counter()
+    for state in states:
+        TableServerModel.HEURISTIC(state)
+    return size, perf_counter() - start
+
+
+@benchmark("model.STEP_COST")
+def bench_step_cost(size):
+    states = random_states(size)
+    transitions = [(state, i % 6, TableServerModel.RESULT(state, i % 6))
+                   for i, state in enumerate(states)]
+    start = perf_counter()
+    for state, action, state_prime in transitions:
+        TableServerModel.STEP_COST(state, action, state_prime)
+    return size, perf_counter() - start
+
+
+@benchmark("env.reset")
+def bench_reset(size):
+    env = TableServerEnv()
+    env.reset(seed=0)
+    start = perf_counter()
+    for _ in range(size):
+        env.reset()
+    return size, perf_counter() - start
+
+
+@benchmark("env.step")
+def bench_step(size, **layout):
+    env = TableServerEnv(**layout)
+    env.reset(seed=0)
+    actions = np.random.default_rng(0).integers(0, 6, size)
+    start = perf_counter()
+    for action in actions:
+        env.step(action)
+    return size, perf_counter() - start
+
+
+@benchmark("env.step.onehot")
+def bench_step_onehot(size):
+    return bench_step(size, observation_mode="onehot", copy_observation=False)
+
+
+@benchmark("env.step.large")
+def bench_step_large(size):
+    return bench_step(size, **LARGE)
+
+
+@benchmark("env.step.recorded")
+def bench_step_recorded(size):
+    env = TableServerRecorder(TableServerEnv(), os.devnull)
+    env.reset(seed=0)
+    actions = np.random.default_rng(0).integers(0, 6, size)
+    start = perf_counter()
+    for action in actions:
+        env.step(action)
+    elapsed = perf_counter() - start
+    env.close()
+    return size, elapsed
+
+
+@benchmark("env.step.subproc")
+def bench_step_subproc(size):
+    # env steps per second of 64 envs over up to 4 worker processes
+    envs = TableServerSubprocVectorEnv(64, num_workers=4, observation_mode="flat", copy=False)
+    envs.reset(seed=0)
+    actions = np.random.default_rng(0).integers(0, 6, (max(1, size // 64), 64))
+    start = perf_counter()
+    for batch in actions:
+        envs.step(batch)
+    elapsed = perf_counter() - start
+    envs.close()
+    return actions.size, elapsed
+
+
+def bench_render(size, render_mode, **kwargs):
+    env = TableServerEnv(render_mode=render_mode, **kwargs)
+    states = random_states(size)
+    env.reset()
+    env.state = states[0]
+    env.render()
+    start = perf_counter()
+    for state in states:
+        env.state = state
+        env.render()
+    elapsed = perf_counter() - start
+    env.close()
+    return size, elapsed
+
+
+@benchmark("env.render.ansi")
+def bench_render_ansi(size):
+    return bench_render(size, "ansi")
+
+
+@benchmark("env.render.rgb_array.numpy")
+def bench_render_numpy(size):
+    return bench_render(max(1, size // 20), "rgb_array", render_backend="numpy")
+
+
+@benchmark("env.render.rgb_array.pygame")
+def bench_render_pygame(size):
+    import pygame
+    # the pygame sprites need a display mode to convert to
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    return bench_render(max(1, size // 20), "rgb_array")
+
+
+# milliseconds of every import.table_server import, without interpreter start up
+IMPORT_MS = []
+
+
+@benchmark("import.table_server")
+def bench_import(size):
+    # a fresh interpreter per import, which must not pull in pygame
+    code = ("import sys\nfrom time import perf_counter\nstart = perf_counter()\n"
+            "import table_server\nprint((perf_counter() - start) * 1000)\n"
+            "sys.exit('pygame' in sys.modules)")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path[:2]))
+    runs = max(3, size // 4000)
+    start = perf_counter()
+    for _ in range(runs):
+        child = subprocess.run([sys.executable, "-c", code], env=env, stdout=subprocess.PIPE, text=True)
+        if child.returncode != 0:
+            raise RuntimeError("import table_server imported pygame or failed")
+        IMPORT_MS.append(float(child.stdout))
+    return runs, perf_counter() - start
+
+
+def bench_search(size, search, seeds=None, **layout):
+    from agent import Agent, Search
+    model = CountingModel()
+    agent = Agent(model)
+    env = TableServerEnv(**layout)
+    elapsed = 0
+    for seed in range(seeds or max(1, size // 2000)):
+        observation, _ = env.reset(seed=seed)
+        start = perf_counter()
+        agent.SEARCHES[Search[search]](observation, model)
+        elapsed += perf_counter() - start
+    return model.generated, elapsed
+
+
+@benchmark("search.A_STAR")
+def bench_a_star(size):
+    return bench_search(size, "A_STAR")
+
+
+@benchmark("search.A_STAR.large")
+def bench_a_star_large(size):
+    return bench_search(size, "A_STAR", seeds=1, **LARGE)
+
+
+@benchmark("search.GREEDY_BEST_FIRST_SEARCH")
+def bench_greedy(size):
+    return bench_search(size, "GREEDY_BEST_FIRST_SEARCH")
+
+
+@benchmark("search.UNIFORM_COST_SEARCH")
+def bench_uniform_cost(size):
+    return bench_search(size, "UNIFORM_COST_SEARCH")
+
+
+def run(names, size, repeat):
+    results = {}
+    for name in names:
+        # best of repeat for speed, a separate traced run for memory
+        best = None
+        for _ in range(repeat):
+            ops, elapsed = BENCHMARKS[name](size)
+            rate = ops / elapsed if elapsed > 0 else float("inf")
+            best = rate if best is None else max(best, rate)
+        tracemalloc.start()
+        BENCHMARKS[name](size)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        unit = "nodes/sec" if name.startswith("search.") else "ops/sec"
+        results[name] = {"rate": best, "unit": unit, "peak_memory": peak}
+        print("{:36s} {:>14,.0f} {:9s} {:>10.1f} KiB peak".format(
+            name, best, unit, peak / 1024))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["rate"] / baseline[name]["rate"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print("{:36s} {:>7.2f}x {}".format(name, ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", nargs="*", default=None, choices=list(BENCHMARKS),
+                        help="only run these benchmarks")
+    parser.add_argument("--size", type=int, default=20000,
+                        help="calls per micro benchmark, searches solve size // 2000 seeds")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="repetitions, the fastest one is kept")
+    parser.add_argument("--output", type=str, default=None,
+                        help="save the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="compare against a JSON file saved with --output")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed slowdown against the baseline, 0.1 = 10%%")
+    parser.add_argument("--max-import-ms", type=float, default=500,
+                        help="fail when the fastest import of import.table_server takes longer, "
+                             "0 = no limit")
+    args = parser.parse_args()
+
+    results = run(args.only or list(BENCHMARKS), args.size, args.repeat)
+    failed = False
+    if IMPORT_MS:
+        fastest = min(IMPORT_MS)
+        results["import.table_server"]["fastest_ms"] = fastest
+        over = 0 < args.max_import_ms < fastest
+        failed = failed or over
+        print("import table_server took {:.1f} ms at best, the limit is {:g} ms{}".format(
+            fastest, args.max_import_ms, " OVER LIMIT" if over else ""))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        failed = compare(results, baseline, args.tolerance) or failed
+    if failed:
+        sys.exit(1)
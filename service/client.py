@@ -0,0 +1,272 @@
+"""
+Binary protocol of the table-server service and an asyncio client for it.
+
+This module only needs numpy, so clients do not import pygame or gymnasium.
+
+Every message is a header followed by a body of body_size bytes. The
+request header is (body_size, op, request_id) and the response header is
+(body_size, status, request_id). A response carries the request_id of the
+request it answers; with several requests in flight they may arrive out of
+order. When status is ERROR the body is a utf-8 message.
+
+    CREATE  height, width, tables, meals, layout_seed (-1 = default), max_episode_steps
+            -> session, height, width, tables, meals, itemsize
+    RESET   session, seed (-1 = unseeded)             -> action mask, observation
+    STEP    session, action                           -> reward, terminated, truncated,
+                                                         action mask, observation
+    STEP_MANY count, count x (session, action)         -> count x STEP response, on ERROR
+                                                         no session was stepped
+    PLAN    session, search, goal                     -> solved, length, length x action
+    CLOSE   session                                   -> empty
+
+Observations are the "flat" encoding of the env (area, held meal, kitchen
+queue padded to meals slots, table bits) as itemsize-byte unsigned ints,
+action masks are one byte with bit i set when action i is legal.
+"""
+import argparse
+import asyncio
+import struct
+from time import perf_counter
+
+import numpy as np
+
+REQUEST = struct.Struct("<IBI")
+RESPONSE = struct.Struct("<IBI")
+
+CREATE = 1
+RESET = 2
+STEP = 3
+STEP_MANY = 4
+PLAN = 5
+CLOSE = 6
+
+OK = 0
+ERROR = 1
+
+CREATE_REQUEST = struct.Struct("<HHHHiI")
+CREATE_RESPONSE = struct.Struct("<IHHHHB")
+RESET_REQUEST = struct.Struct("<Iq")
+STEP_REQUEST = struct.Struct("<IB")
+STEP_RESPONSE = struct.Struct("<bBBB")
+COUNT = struct.Struct("<H")
+PLAN_REQUEST = struct.Struct("<IBB")
+PLAN_RESPONSE = struct.Struct("<BH")
+SESSION = struct.Struct("<I")
+
+# the search and goal numbers of agents/agent.py
+SEARCHES = ("A_STAR", "GREEDY_BEST_FIRST_SEARCH", "UNIFORM_COST_SEARCH", "IDA_STAR",
+            "BEAM_SEARCH", "SMA_STAR", "HIERARCHICAL")
+GOALS = ("FIRST", "SECOND", "THIRD")
+
+DTYPES = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+
+
+class ServiceError(Exception):
+    """
+    An ERROR response of the service
+    """
+
+
+def unpack_mask(bits):
+    return np.unpackbits(np.array([bits], dtype=np.uint8), count=6,
+                         bitorder="little").astype(bool)
+
+
+class Session:
+    """
+    A server-side env, sessions are made by TableServerClient.create
+    """
+
+    def __init__(self, client, session, height, width, tables, meals, itemsize):
+        self.client = client
+        self.id = session
+        self.height = height
+        self.width = width
+        self.tables = tables
+        self.meals = meals
+        self.dtype = np.dtype(DTYPES[itemsize])
+        self.size = height * width + 1 + meals + tables
+        # bytes of a STEP response
+        self.step_size = STEP_RESPONSE.size + self.size * itemsize
+
+    def observation(self, data):
+        """
+        The flat observation in data as an array
+        """
+        return np.frombuffer(data, dtype=self.dtype, count=self.size)
+
+    def split(self, observation):
+        """
+        Observation dict of a flat observation, like the dict mode of the env
+        """
+        cells = self.height * self.width
+        queue = observation[cells + 1:cells + 1 + self.meals].astype(np.int32)
+        return {
+            "area": observation[:cells].reshape(self.height, self.width).astype(np.int32),
+            "playerStatus": int(observation[cells]),
+            "kitchen_meals": queue[queue > 0],
+            "table_status": observation[cells + 1 + self.meals:].astype(np.int32),
+        }
+
+    def _step_result(self, data):
+        reward, terminated, truncated, bits = STEP_RESPONSE.unpack_from(data)
+        observation = self.observation(data[STEP_RESPONSE.size:])
+        return observation, reward, bool(terminated), bool(truncated), {"action_mask": unpack_mask(bits)}
+
+    async def reset(self, seed=None):
+        data = await self.client.request(
+            RESET, RESET_REQUEST.pack(self.id, -1 if seed is None else seed))
+        return self.observation(data[1:]), {"action_mask": unpack_mask(data[0])}
+
+    async def step(self, action):
+        data = await self.client.request(STEP, STEP_REQUEST.pack(self.id, action))
+        return self._step_result(data)
+
+    async def plan(self, search="A_STAR", goal="THIRD"):
+        """
+        Actions that reach goal from the current state, searched by the
+        service, and whether the search solved it
+        """
+        search = SEARCHES.index(search) if isinstance(search, str) else int(search)
+        goal = GOALS.index(goal) if isinstance(goal, str) else int(goal)
+        data = await self.client.request(PLAN, PLAN_REQUEST.pack(self.id, search, goal))
+        solved, length = PLAN_RESPONSE.unpack_from(data)
+        if not solved:
+            return None, False
+        return list(data[PLAN_RESPONSE.size:PLAN_RESPONSE.size + length]), True
+
+    async def close(self):
+        await self.client.request(CLOSE, SESSION.pack(self.id))
+
+
+class TableServerClient:
+    """
+    asyncio client of the service. Requests may be sent from many tasks at
+    once, they are pipelined on one connection.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._next_id = 0
+        self._pending = {}
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=7001, path=None):
+        """
+        Connect over TCP, or to the Unix socket at path when given
+        """
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _receive(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(RESPONSE.size)
+                size, status, request_id = RESPONSE.unpack(header)
+                body = await self._reader.readexactly(size)
+                future = self._pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if status == OK:
+                    future.set_result(body)
+                else:
+                    future.set_exception(ServiceError(body.decode()))
+        except (asyncio.IncompleteReadError, ConnectionError) as error:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("connection to the service lost: {}".format(error)))
+            self._pending.clear()
+
+    async def request(self, op, body=b""):
+        """
+        Send one request and wait for the body of its response
+        """
+        if self._receiver.done():
+            raise ConnectionError("connection to the service is closed")
+        request_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(REQUEST.pack(len(body), op, request_id) + body)
+        # waits while the service is not reading, which is the backpressure
+        await self._writer.drain()
+        return await future
+
+    async def create(self, height=5, width=7, tables=3, meals=3, layout_seed=None,
+                     max_episode_steps=80):
+        data = await self.request(CREATE, CREATE_REQUEST.pack(
+            height, width, tables, meals, -1 if layout_seed is None else layout_seed,
+            max_episode_steps))
+        return Session(self, *CREATE_RESPONSE.unpack(data))
+
+    async def step_many(self, sessions, actions):
+        """
+        Step every session with its action in one request, results in order
+        """
+        body = COUNT.pack(len(sessions)) + b"".join(
+            STEP_REQUEST.pack(session.id, action) for session, action in zip(sessions, actions))
+        data = await self.request(STEP_MANY, body)
+        results = []
+        offset = 0
+        for session in sessions:
+            results.append(session._step_result(data[offset:offset + session.step_size]))
+            offset += session.step_size
+        return results
+
+    async def close(self):
+        self._receiver.cancel()
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def demo(args):
+    """
+    Play sessions with random legal actions and plan from their start states
+    """
+    client = await TableServerClient.connect(args.host, args.port, args.unix)
+    sessions = [await client.create() for _ in range(args.sessions)]
+    rng = np.random.default_rng(0)
+    masks = []
+    for i, session in enumerate(sessions):
+        _, info = await session.reset(seed=i)
+        masks.append(info["action_mask"])
+
+    start = perf_counter()
+    for _ in range(args.steps):
+        actions = [rng.choice(np.flatnonzero(mask)) for mask in masks]
+        results = await client.step_many(sessions, actions)
+        masks = [info["action_mask"] for *_, info in results]
+    elapsed = perf_counter() - start
+    print("{} session steps in {:.3f}s, {:,.0f} steps/sec".format(
+        args.sessions * args.steps, elapsed, args.sessions * args.steps / elapsed))
+
+    for i, session in enumerate(sessions):
+        await session.reset(seed=i)
+    start = perf_counter()
+    plans = await asyncio.gather(*[session.plan(args.search) for session in sessions])
+    print("{} plans in {:.3f}s, lengths {}".format(
+        len(plans), perf_counter() - start, [len(plan) for plan, _ in plans]))
+    for session in sessions:
+        await session.close()
+    await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7001)
+    parser.add_argument("--unix", type=str, default=None,
+                        help="connect to this Unix socket instead of TCP")
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=1000,
+                        help="batched steps of all sessions")
+    parser.add_argument("--search", type=str, default="A_STAR", choices=SEARCHES)
+    asyncio.run(demo(parser.parse_args()))
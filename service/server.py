@@ -0,0 +1,282 @@
+"""
+asyncio service that keeps table-server envs in one warm process for many
+clients, over TCP or a Unix socket.
+
+    python service/server.py --port 7001 --workers 2
+    python service/server.py --unix /tmp/table-server.sock
+
+The protocol is described in service/client.py. Reset and step are handled
+on the event loop, searches of PLAN requests run in a pool of worker
+processes. Layouts are cached by get_layout, plans by a PlanCache keyed by
+layout and state, so the same start configuration is searched only once.
+
+Backpressure: a connection is not read while --max-plans searches are
+waiting for or running in the pool, and not read while its responses have
+not been taken by the client, so a fast client ends up waiting in its own
+drain() instead of growing the queues of the service.
+"""
+import argparse
+import asyncio
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "table-server"))
+sys.path.insert(0, os.path.join(here, "..", "agents"))
+
+from table_server.envs import TableServerEnv, TableServerModel  # noqa: E402
+from table_server.envs.table_server_model import PlayerIndex, area_high  # noqa: E402
+from agent import Agent, Goal, PlanCache, Search  # noqa: E402
+from client import (REQUEST, RESPONSE, CREATE, RESET, STEP, STEP_MANY, PLAN, CLOSE, OK, ERROR,  # noqa: E402
+                    CREATE_REQUEST, CREATE_RESPONSE, RESET_REQUEST, STEP_REQUEST, STEP_RESPONSE,
+                    COUNT, PLAN_REQUEST, PLAN_RESPONSE, SESSION)
+
+
+def check_action(action):
+    if not 0 <= action < 6:
+        raise ValueError("action must be in [0, 6), not {}".format(action))
+
+
+class ServiceSession:
+    """
+    One env of a client, observed in the flat mode straight into one buffer
+    """
+
+    def __init__(self, height, width, tables, meals, layout_seed, max_episode_steps):
+        high = area_high(tables)
+        self.dtype = np.uint8 if high <= 0xFF else np.uint16
+        self.env = TableServerEnv(height=height, width=width, tables=tables, meals=meals,
+                                  layout_seed=layout_seed, observation_mode="flat",
+                                  observation_dtype=self.dtype, copy_observation=False)
+        self.max_episode_steps = max_episode_steps
+        self.steps = 0
+
+    def action_bits(self):
+        state = self.env.state
+        player_row, player_col = state._player_pos
+        return int(state._layout.action_bits[player_row, player_col,
+                                             int(state._playerStatus != PlayerIndex.NONE.value)])
+
+    def reset(self, seed):
+        observation, _ = self.env.reset(seed=None if seed < 0 else seed)
+        self.steps = 0
+        return bytes((self.action_bits(),)) + observation.tobytes()
+
+    def step(self, action):
+        check_action(action)
+        observation, reward, terminated, _, _ = self.env.step(action)
+        self.steps += 1
+        truncated = self.steps >= self.max_episode_steps
+        return STEP_RESPONSE.pack(int(reward), terminated, truncated, self.action_bits()) + observation.tobytes()
+
+    def start(self):
+        """
+        Observation dict of the current state that later steps do not change
+        """
+        observation = self.env.state.observation
+        for key in ["area", "kitchen_meals", "table_status"]:
+            observation[key] = observation[key].copy()
+        return observation
+
+
+class TableServerService:
+    """
+    Sessions, the plan cache and the search pool shared by all connections
+    """
+
+    def __init__(self, workers=1, max_sessions=1024, max_plans=None, plan_cache=1024,
+                 plan_store=None, node_budget=100000, beam_width=32):
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self._next_session = 0
+        self.plan_cache = PlanCache(plan_cache, plan_store)
+        self.pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                        initargs=(node_budget, beam_width))
+        # searches waiting for or running in the pool
+        self._plan_slots = asyncio.Semaphore(max_plans or 2 * workers)
+        # the event loop only keeps weak references to tasks
+        self._plans = set()
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=7001, path=None):
+        """
+        Listen on host:port, or on the Unix socket at path when given
+        """
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._serve, path)
+        else:
+            self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self.pool.shutdown(cancel_futures=True)
+        self.plan_cache.close()
+
+    async def _serve(self, reader, writer):
+        owned = set()
+        try:
+            while True:
+                header = await reader.readexactly(REQUEST.size)
+                size, op, request_id = REQUEST.unpack(header)
+                body = await reader.readexactly(size)
+                if op == PLAN:
+                    # stop reading this connection while the pool is full
+                    await self._plan_slots.acquire()
+                    plan = asyncio.ensure_future(self._plan(writer, request_id, body))
+                    self._plans.add(plan)
+                    plan.add_done_callback(self._plan_done)
+                    continue
+                try:
+                    response = self._handle(op, body, owned)
+                except Exception as error:
+                    self._reply(writer, request_id, ERROR, str(error).encode())
+                else:
+                    self._reply(writer, request_id, OK, response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # sessions do not outlive the connection that created them. Its
+            # plans are not cancelled, a search already in the pool runs on
+            # and keeps its slot until it is done
+            for session in owned:
+                self.sessions.pop(session, None)
+            writer.close()
+
+    def _plan_done(self, plan):
+        # a task cancelled before it ran never enters _plan, so the slot is
+        # given back here rather than in _plan
+        self._plans.discard(plan)
+        self._plan_slots.release()
+
+    def _reply(self, writer, request_id, status, body):
+        if not writer.is_closing():
+            writer.write(RESPONSE.pack(len(body), status, request_id) + body)
+
+    def _session(self, session):
+        if session not in self.sessions:
+            raise ValueError("no session {}".format(session))
+        return self.sessions[session]
+
+    def _handle(self, op, body, owned):
+        if op == STEP:
+            session, action = STEP_REQUEST.unpack(body)
+            return self._session(session).step(action)
+        if op == STEP_MANY:
+            count, = COUNT.unpack_from(body)
+            if len(body) != COUNT.size + count * STEP_REQUEST.size:
+                raise ValueError("STEP_MANY of {} steps needs {} bytes, not {}".format(
+                    count, COUNT.size + count * STEP_REQUEST.size, len(body)))
+            # the whole batch is checked first, an ERROR leaves every session as it was
+            steps = [(self._session(session), action)
+                     for session, action in STEP_REQUEST.iter_unpack(body[COUNT.size:])]
+            for _, action in steps:
+                check_action(action)
+            return b"".join(session.step(action) for session, action in steps)
+        if op == RESET:
+            session, seed = RESET_REQUEST.unpack(body)
+            return self._session(session).reset(seed)
+        if op == CREATE:
+            height, width, tables, meals, layout_seed, max_episode_steps = CREATE_REQUEST.unpack(body)
+            if len(self.sessions) >= self.max_sessions:
+                raise ValueError("the service has its maximum of {} sessions".format(self.max_sessions))
+            self.sessions[self._next_session] = ServiceSession(
+                height, width, tables, meals, None if layout_seed < 0 else layout_seed,
+                max_episode_steps)
+            owned.add(self._next_session)
+            self._next_session += 1
+            return CREATE_RESPONSE.pack(self._next_session - 1, height, width, tables, meals,
+                                        np.dtype(self.sessions[self._next_session - 1].dtype).itemsize)
+        if op == CLOSE:
+            session, = SESSION.unpack(body)
+            self._session(session)
+            del self.sessions[session]
+            owned.discard(session)
+            return b""
+        raise ValueError("unknown op {}".format(op))
+
+    async def _plan(self, writer, request_id, body):
+        if writer.is_closing():
+            # the client is gone, do not search for it
+            return
+        try:
+            session, search, goal = PLAN_REQUEST.unpack(body)
+            session = self._session(session)
+            search, goal = Search(search), Goal(goal)
+            start = session.start()
+            key = self.plan_cache.key(start, search.name, goal.name)
+            path = self.plan_cache.get(key)
+            solved = path is not None
+            if not solved:
+                path, solved = await asyncio.get_running_loop().run_in_executor(
+                    self.pool, _plan, start, search, goal)
+                if solved:
+                    self.plan_cache.put(key, path)
+            if not solved:
+                path = []
+            self._reply(writer, request_id, OK,
+                        PLAN_RESPONSE.pack(solved, len(path)) + bytes(int(action) for action in path))
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            self._reply(writer, request_id, ERROR, str(error).encode())
+
+
+# every pool worker builds its own agent once
+_worker_agent = None
+
+
+def _init_worker(node_budget, beam_width):
+    global _worker_agent
+    _worker_agent = Agent(TableServerModel, node_budget=node_budget, beam_width=beam_width)
+
+
+def _plan(start, search, goal):
+    path, solved = _worker_agent.plan(start, search, goal)
+    return ([] if path is None else [int(action) for action in path]), solved
+
+
+async def main(args):
+    service = TableServerService(args.workers, args.max_sessions, args.max_plans,
+                                 args.plan_cache, args.plan_store, args.node_budget, args.beam_width)
+    await service.start(args.host, args.port, args.unix)
+    print("serving on {}".format(args.unix or "{}:{}".format(args.host, args.port)))
+    try:
+        await service.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7001)
+    parser.add_argument("--unix", type=str, default=None,
+                        help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for the searches of PLAN requests")
+    parser.add_argument("--max-sessions", type=int, default=1024,
+                        help="sessions of all connections together")
+    parser.add_argument("--max-plans", type=int, default=None,
+                        help="searches queued or running before connections stop being read, 2 per worker by default")
+    parser.add_argument("--plan-cache", type=int, default=1024, metavar="SIZE",
+                        help="plans kept in memory")
+    parser.add_argument("--plan-store", type=str, default=None,
+                        help="sqlite file that keeps cached plans between runs")
+    parser.add_argument("--node-budget", type=int, default=100000,
+                        help="most nodes IDA_STAR, BEAM_SEARCH and SMA_STAR may hold")
+    parser.add_argument("--beam-width", type=int, default=32,
+                        help="nodes BEAM_SEARCH keeps per depth")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
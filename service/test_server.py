@@ -0,0 +1,103 @@
+"""
+Localhost regression tests of the service, run with
+
+    python -m pytest service
+"""
+import asyncio
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from client import REQUEST, PLAN, PLAN_REQUEST, ServiceError, TableServerClient  # noqa: E402
+from server import TableServerService  # noqa: E402
+
+
+def serve(test):
+    """
+    Run test(service, port) against a service with one worker and one plan slot
+    """
+    async def main():
+        service = TableServerService(workers=1, max_plans=1)
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            await asyncio.wait_for(test(service, port), 60)
+        finally:
+            service.close()
+    asyncio.run(main())
+
+
+def test_plan_slot_survives_disconnect():
+    async def test(service, port):
+        for _ in range(3):
+            # a blocking socket sends the PLAN request and the end of the
+            # connection before the service reads, so both arrive in one read
+            with socket.create_connection(("127.0.0.1", port)) as raw:
+                raw.sendall(REQUEST.pack(PLAN_REQUEST.size, PLAN, 0) + PLAN_REQUEST.pack(0, 0, 2))
+                raw.shutdown(socket.SHUT_WR)
+
+        client = await TableServerClient.connect(port=port)
+        session = await client.create()
+        await session.reset(seed=0)
+        path, solved = await session.plan()
+        assert solved and len(path) > 0
+        await client.close()
+        while service._plans:
+            await asyncio.sleep(0.01)
+        assert service._plan_slots._value == 1
+    serve(test)
+
+
+def test_plan_slot_held_while_pool_searches():
+    async def test(service, port):
+        client = await TableServerClient.connect(port=port)
+        session = await client.create(height=20, width=20, tables=6, meals=6, layout_seed=0)
+        await session.reset(seed=0)
+        plan = asyncio.ensure_future(session.plan("UNIFORM_COST_SEARCH"))
+        while not service._plans:
+            await asyncio.sleep(0.01)
+        await client.close()
+        await asyncio.sleep(0.05)
+        # the search goes on in the pool after the disconnect
+        assert service._plans and service._plan_slots._value == 0
+        while service._plans:
+            await asyncio.sleep(0.01)
+        assert service._plan_slots._value == 1
+        plan.cancel()
+    serve(test)
+
+
+def test_step_many_error_steps_no_session():
+    async def test(service, port):
+        client = await TableServerClient.connect(port=port)
+        sessions = [await client.create() for _ in range(2)]
+        for session in sessions:
+            await session.reset(seed=0)
+        try:
+            await client.step_many(sessions, [1, 6])
+        except ServiceError:
+            pass
+        else:
+            raise AssertionError("an action of 6 was stepped")
+        assert [service.sessions[session.id].steps for session in sessions] == [0, 0]
+        results = await client.step_many(sessions, [1, 1])
+        assert [service.sessions[session.id].steps for session in sessions] == [1, 1]
+        assert (results[0][0] == results[1][0]).all()
+        await client.close()
+    serve(test)
+
+
+def test_plan_while_holding_a_meal():
+    async def test(service, port):
+        client = await TableServerClient.connect(port=port)
+        session = await client.create()
+        await session.reset(seed=0)
+        path, solved = await session.plan("A_STAR", "FIRST")
+        for action in path:
+            await session.step(action)
+        path, solved = await session.plan("A_STAR")
+        assert solved and len(path) > 0
+        await client.close()
+    serve(test)
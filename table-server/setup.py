@@ -3,5 +3,7 @@ from setuptools import setup
 setup(
     name="table_server",
     version="0.0.1",
+    packages=["table_server", "table_server.envs"],
+    package_data={"table_server.envs": ["imgs/*.png"]},
     install_requires=["gym>=0.26.0", "pygame>=2.1.0"],
 )
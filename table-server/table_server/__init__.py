@@ -3,11 +3,22 @@ from gymnasium.envs.registration import register
 from table_server.envs.table_server_env import TableServerEnv
 from table_server.envs.table_server_model import TableServerModel
 from table_server.envs.table_server_model import TableServerState
+from table_server.envs.table_server_model import TableServerLayout
+from table_server.envs.table_server_model import TableServerLayoutModel
+from table_server.envs.table_server_tabular import TableServerTabularModel
+from table_server.envs.table_server_vector_env import TableServerVectorEnv
+from table_server.envs.table_server_subproc_vector_env import TableServerSubprocVectorEnv
+from table_server.envs.table_server_renderer import TableServerRenderer
+from table_server.envs.table_server_observation import TableServerObservation
+from table_server.envs.table_server_recorder import TableServerRecorder, TableServerReplay
+from table_server.envs.table_server_export import TableServerExporter
 
 register(
     id="table_server/TableServer-v0",
 
     entry_point="table_server.envs:TableServerEnv",
 
+    vector_entry_point="table_server.envs:TableServerVectorEnv",
+
     max_episode_steps=80,
 )
@@ -1,3 +1,12 @@
 from table_server.envs.table_server_env import TableServerEnv
 from table_server.envs.table_server_model import TableServerModel
 from table_server.envs.table_server_model import TableServerState
+from table_server.envs.table_server_model import TableServerLayout
+from table_server.envs.table_server_model import TableServerLayoutModel
+from table_server.envs.table_server_tabular import TableServerTabularModel
+from table_server.envs.table_server_vector_env import TableServerVectorEnv
+from table_server.envs.table_server_subproc_vector_env import TableServerSubprocVectorEnv
+from table_server.envs.table_server_renderer import TableServerRenderer
+from table_server.envs.table_server_observation import TableServerObservation
+from table_server.envs.table_server_recorder import TableServerRecorder, TableServerReplay
+from table_server.envs.table_server_export import TableServerExporter
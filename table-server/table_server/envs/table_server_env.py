@@ -1,35 +1,44 @@
 import gymnasium as gym
 import numpy as np
-from table_server.envs.table_server_model import TableServerState, AreaIndex, PlayerIndex, ActionIndex, TableServerModel
+from table_server.envs.table_server_model import TableServerState, ActionIndex, TableServerModel, get_layout, area_high, start_configuration
+from table_server.envs.table_server_renderer import TableServerRenderer, sprite_status, asset_path
+from table_server.envs.table_server_observation import TableServerObservation
 from gymnasium import spaces
-import os
-
-try:
-    import pygame
-except ImportError as e:
-    raise DependencyNotInstalled(
-        "{}. (HINT: you can install PyGame dependencies by running 'pip install pygame --user')".format(e))
+from gymnasium.error import DependencyNotInstalled
 
 # credit: https://pixelfight.itch.io/birdcat
-server_no_food_sheet_path = "../table-server/table_server/envs/imgs/server_0.png"
-server_table_1_sheet_path = "../table-server/table_server/envs/imgs/server_1.png"
-server_table_2_sheet_path = "../table-server/table_server/envs/imgs/server_2.png"
-server_table_3_sheet_path = "../table-server/table_server/envs/imgs/server_3.png"
+server_no_food_sheet_path = asset_path("server_0.png")
+server_table_1_sheet_path = asset_path("server_1.png")
+server_table_2_sheet_path = asset_path("server_2.png")
+server_table_3_sheet_path = asset_path("server_3.png")
 
 # all food sprites come from bellow same with the kitchen(fridge)
 # credit: https://piiixl.itch.io/mega-pixel-art-32x32-px-icons-sprite-sheet
-kitchen_sprite_sheet_path = "../table-server/table_server/envs/imgs/kitchen.png"
+kitchen_sprite_sheet_path = asset_path("kitchen.png")
 
 # credit: https://havran.itch.io/wooden-barrel
-wall_sprite_path = "../table-server/table_server/envs/imgs/barrel.png"
+wall_sprite_path = asset_path("barrel.png")
 
 # credit: https://joao9396.itch.io/pixel-nature-pack
-table_unserved_sprite_path = "../table-server/table_server/envs/imgs/table.png"
-table1_served_path = "../table-server/table_server/envs/imgs/table_1.png"
-table2_served_path = "../table-server/table_server/envs/imgs/table_2.png"
-table3_served_path = "../table-server/table_server/envs/imgs/table_3.png"
+table_unserved_sprite_path = asset_path("table.png")
+table1_served_path = asset_path("table_1.png")
+table2_served_path = asset_path("table_2.png")
+table3_served_path = asset_path("table_3.png")
+
+background_sprite_path = asset_path("background.png")
 
-background_sprite_path = "../table-server/table_server/envs/imgs/background.png"
+
+def import_pygame():
+    """
+    pygame, imported the first time a window or pygame frame is drawn, so
+    search and headless users never pay for it
+    """
+    try:
+        import pygame
+    except ImportError as e:
+        raise DependencyNotInstalled(
+            "{}. (HINT: you can install PyGame dependencies by running 'pip install pygame --user')".format(e))
+    return pygame
 
 
 class TableServerEnv(gym.Env):
@@ -38,54 +47,132 @@ class TableServerEnv(gym.Env):
                 "render_fps": 20,
                 }
 
-    def __init__(self, render_mode=None, height=5, width=7, tables=3, meals=3):
+    def __init__(self, render_mode=None, height=5, width=7, tables=3, meals=3, render_backend="pygame", layout_seed=None,
+                 observation_mode="dict", observation_buffer=None, copy_observation=True,
+                 observation_dtype=np.float32):
         self.render_mode = render_mode
+        # "numpy" draws rgb_array frames without pygame
+        self.render_backend = render_backend
         self.action_space = spaces.Discrete(6)
         self.height = height
         self.width = width
         self.tables = tables
         self.meals = meals
+        # the default restaurant for the default size, otherwise generated from layout_seed
+        self.layout = get_layout(height, width, tables, layout_seed)
+        self.layout_seed = layout_seed
         self._last_action = None
         self.observation_space = spaces.Dict(
             {
-                "area": spaces.Box(low=0, high=6, shape=(height, width), dtype=np.int32),
-                "playerStatus": spaces.Discrete(4),
-                "kitchen_meals": spaces.Box(low=0, high=3, shape=(3,), dtype=np.int32),
-                "table_status": spaces.Box(low=0, high=1, shape=(3,), dtype=np.int32),
+                "area": spaces.Box(low=0, high=area_high(tables), shape=(height, width), dtype=np.int32),
+                "playerStatus": spaces.Discrete(tables + 1),
+                "kitchen_meals": spaces.Box(low=0, high=tables, shape=(meals,), dtype=np.int32),
+                "table_status": spaces.Box(low=0, high=1, shape=(tables,), dtype=np.int32),
             }
         )
 
+        # "flat" and "onehot" write fixed-shape arrays into one buffer, which
+        # can be given (a row of a training batch) and is returned without a
+        # copy when copy_observation is False
+        self.observation_mode = observation_mode
+        self.copy_observation = copy_observation
+        self._encoder = None
+        if observation_mode != "dict":
+            self._encoder = TableServerObservation(
+                height, width, tables, meals, observation_mode, observation_dtype)
+            self.observation_space = self._encoder.space
+            if observation_buffer is None:
+                observation_buffer = self._encoder.buffer()
+            self.observation_buffer = self._encoder.check(observation_buffer)
+
         # display stuff
         # self.cell_size = 800 // max(height, width)
         self.cell_size = 64
         self.window_size = (self.cell_size * width, self.cell_size * height)
         self.window_surface = None
         self.clock = None
+        # sprites are loaded and scaled once, background and walls drawn once
+        self._sprites = None
+        self._static_surface = None
+        self._renderer = None
+
+        # ready start states by start configuration, at most max_templates
+        self._templates = {}
+        self.max_templates = 1024
         return
 
     def reset(self, seed=None, options=None):
         super().reset(seed=seed)
-        self.state = TableServerState(
-            self.height, self.width, self.tables, self.meals)
-        observation = self.state.observation
-        info = {}
+        # a start configuration can be given, like one of start_configurations,
+        # otherwise it is drawn from the generator of this env
+        if options is not None and ("kitchen_meals" in options or "table_spawns" in options):
+            for key in ["kitchen_meals", "table_spawns"]:
+                if key not in options:
+                    raise ValueError("a start configuration needs both kitchen_meals and "
+                                     "table_spawns, {} is missing".format(key))
+            kitchen_meals = np.asarray(options["kitchen_meals"], dtype=np.int32)
+            table_spawns = np.asarray(options["table_spawns"], dtype=np.int64)
+        else:
+            kitchen_meals, table_spawns = start_configuration(
+                self.layout, self.meals, self.np_random)
+        self.state = self._start_state(kitchen_meals, table_spawns)
+        if self._encoder is None:
+            observation = self._observe_dict()
+        else:
+            observation = self._observe(self._encoder.write(
+                self.state, self.observation_buffer))
+        info = {"action_mask": TableServerModel.ACTION_MASK(self.state)}
         return observation, info
 
+    def _start_state(self, kitchen_meals, table_spawns):
+        """
+        Copy of the drawn and ready state kept for this start configuration
+        """
+        key = (kitchen_meals.tobytes(), table_spawns.tobytes())
+        template = self._templates.get(key)
+        if template is None:
+            template = TableServerState(self.height, self.width, self.tables, self.meals,
+                                        kitchen_meals=kitchen_meals, table_spawns=table_spawns,
+                                        layout=self.layout)
+            if len(self._templates) < self.max_templates:
+                self._templates[key] = template
+        state = template.copy()
+        state._area = template.area.copy()
+        return state
+
     def step(self, action):
-        state = self.state
-        state_prime = TableServerModel.RESULT(state, action)
-        self.state = state_prime
+        # the env has no use for the old state, so it is changed in place,
+        # search users get copies from TableServerModel.RESULT
+        previous_pos = self.state._player_pos
+        reward, terminated = self.state.step(action)
 
-        observation = state_prime.observation
-        reward = TableServerModel.STEP_COST(state, action, state_prime)
-        terminated = TableServerModel.GOAL_TEST(state_prime)
-        info = {}
+        if self._encoder is None:
+            observation = self._observe_dict()
+        else:
+            observation = self._observe(self._encoder.update(
+                self.state, self.observation_buffer, previous_pos))
+        # read-only view into the layout's table of legal actions
+        info = {"action_mask": TableServerModel.ACTION_MASK(self.state)}
 
         # display
         if self.render_mode == "human":
             self.render(action=action)
         return observation, reward, terminated, False, info
 
+    def _observe_dict(self):
+        observation = self.state.observation
+        # the state is changed in place by the next step and its arrays are
+        # shared with the start template
+        if self.copy_observation:
+            for key in ["area", "kitchen_meals", "table_status"]:
+                observation[key] = observation[key].copy()
+        return observation
+
+    def _observe(self, buffer):
+        if self.copy_observation:
+            return buffer.copy()
+        return buffer
+
     def render(self, action=None):
         if self.render_mode is None:
             assert self.spec is not None
@@ -95,13 +182,22 @@ class TableServerEnv(gym.Env):
 
         if self.render_mode == "ansi":
             return self._render_text()
+        elif self.render_mode == "rgb_array" and self.render_backend == "numpy":
+            return self._render_array(action=action)
         else:
             return self._render_gui(self.render_mode, action=action)
 
     def _render_text(self):
         return str(self.state)
 
+    def _render_array(self, action=None):
+        if self._renderer is None:
+            self._renderer = TableServerRenderer(
+                self.height, self.width, self.cell_size)
+        return self._renderer.render(self.state, action, self._last_action)
+
     def _render_gui(self, mode, action=None):
+        pygame = import_pygame()
         if self.window_surface is None:
             pygame.init()
 
@@ -114,101 +210,33 @@ class TableServerEnv(gym.Env):
         if self.clock is None:
             self.clock = pygame.time.Clock()
 
-        # draw background
-        background_sprite = pygame.image.load(background_sprite_path).convert()
-        background_sprite = pygame.transform.scale(
-            background_sprite, self.window_size)
-        background_sprite.set_colorkey((0, 0, 0))
-        self.window_surface.blit(background_sprite, (0, 0))
+        if self._sprites is None:
+            self._load_sprites()
+        if self._static_surface is None:
+            self._draw_static_surface()
+
+        # background and walls never change
+        self.window_surface.blit(self._static_surface, (0, 0))
+
+        # draw kitchen, unless the server is standing on it
+        player_pos = self.state._player_pos
+        kitchen_row, kitchen_col = self.state._kitchen_pos
+        if player_pos != self.state._kitchen_pos:
+            self.window_surface.blit(self._sprites["kitchen"], (kitchen_col * self.cell_size,
+                                                                kitchen_row * self.cell_size))
+
+        # draw tables, unless the server is standing on them
+        for table, (table_row, table_col) in enumerate(self.state._table_spawns):
+            if player_pos == (table_row, table_col):
+                continue
+            if self.state._table_status[table] == 0:
+                table_sprite = self._sprites["table"]
+            else:
+                table_sprite = self._sprites["served"][table % 3]
+            self.window_surface.blit(table_sprite, (table_col * self.cell_size,
+                                                    table_row * self.cell_size))
 
-        # draw walls
-        walls = np.where(self.state._restaurant["area"] == AreaIndex.WALL)
-        for i in range(len(walls[0])):
-            # wall_rect = pygame.Rect(
-            #     walls[1][i] * self.cell_size, walls[0][i] * self.cell_size, self.cell_size, self.cell_size)
-            # pygame.draw.rect(self.window_surface,
-            #                  (0, 0, 0), wall_rect)
-            wall_sprite = pygame.image.load(
-                wall_sprite_path).convert_alpha()
-            wall_sprite = pygame.transform.scale(
-                wall_sprite, (self.cell_size, self.cell_size))
-            self.window_surface.blit(
-                wall_sprite, (walls[1][i] * self.cell_size, walls[0][i] * self.cell_size))
-
-        # draw kitchen
-        kitchen_col, kitchen_row = np.where(
-            self.state._restaurant["area"] == AreaIndex.KITCHEN)
-        if len(kitchen_col) >= 1 and len(kitchen_row) >= 1:
-            kitchen_sprite = pygame.image.load(
-                kitchen_sprite_sheet_path).convert_alpha()
-            kitchen_sprite = pygame.transform.scale(
-                kitchen_sprite, (self.cell_size, self.cell_size))
-            self.window_surface.blit(kitchen_sprite, (kitchen_row[0] * self.cell_size,
-                                                      kitchen_col[0] * self.cell_size))
-
-        # draw tables
-        table1_col, table1_row = np.where(
-            self.state._restaurant["area"] == AreaIndex.TABLE1)
-        table2_col, table2_row = np.where(
-            self.state._restaurant["area"] == AreaIndex.TABLE2)
-        table3_col, table3_row = np.where(
-            self.state._restaurant["area"] == AreaIndex.TABLE3)
-
-        # draw table 1
-        if len(table1_col) >= 1 and len(table1_row) >= 1:
-            if self.state._restaurant["table_status"][0] == 0:
-                table_sprite = pygame.image.load(
-                    table_unserved_sprite_path).convert_alpha()
-            elif self.state._restaurant["table_status"][0] == 1:
-                table_sprite = pygame.image.load(
-                    table1_served_path).convert_alpha()
-            table_sprite = pygame.transform.scale(
-                table_sprite, (self.cell_size, self.cell_size))
-            self.window_surface.blit(table_sprite, (table1_row[0] * self.cell_size,
-                                                    table1_col[0] * self.cell_size))
-        # draw table 2
-        if len(table2_col) >= 1 and len(table2_row) >= 1:
-            if self.state._restaurant["table_status"][1] == 0:
-                table_sprite = pygame.image.load(
-                    table_unserved_sprite_path).convert_alpha()
-            elif self.state._restaurant["table_status"][1] == 1:
-                table_sprite = pygame.image.load(
-                    table2_served_path).convert_alpha()
-            table_sprite = pygame.transform.scale(
-                table_sprite, (self.cell_size, self.cell_size))
-            self.window_surface.blit(table_sprite, (table2_row[0] * self.cell_size,
-                                                    table2_col[0] * self.cell_size))
-
-        # draw table 3
-        if len(table3_col) >= 1 and len(table3_row) >= 1:
-            if self.state._restaurant["table_status"][2] == 0:
-                table_sprite = pygame.image.load(
-                    table_unserved_sprite_path).convert_alpha()
-            elif self.state._restaurant["table_status"][2] == 1:
-                table_sprite = pygame.image.load(
-                    table3_served_path).convert_alpha()
-            table_sprite = pygame.transform.scale(
-                table_sprite, (self.cell_size, self.cell_size))
-            self.window_surface.blit(table_sprite, (table3_row[0] * self.cell_size,
-                                                    table3_col[0] * self.cell_size))
-
-        player_col, player_row = np.where(
-            self.state._restaurant["area"] == AreaIndex.SERVER)
-
-        if self.state._restaurant["playerStatus"] == PlayerIndex.NONE:
-            sprite_sheet = pygame.image.load(
-                server_no_food_sheet_path).convert_alpha()
-
-        elif self.state._restaurant["playerStatus"] == PlayerIndex.MEAL1:
-            sprite_sheet = pygame.image.load(
-                server_table_1_sheet_path).convert_alpha()
-
-        elif self.state._restaurant["playerStatus"] == PlayerIndex.MEAL2:
-            sprite_sheet = pygame.image.load(
-                server_table_2_sheet_path).convert_alpha()
-        else:
-            sprite_sheet = pygame.image.load(
-                server_table_3_sheet_path).convert_alpha()
+        player_row, player_col = player_pos
 
         if action == ActionIndex.UP:
             frame = 2
@@ -229,9 +257,10 @@ class TableServerEnv(gym.Env):
                 frame = 1
             else:
                 frame = 0
-        server = get_image(sprite_sheet, frame, 32, 32, 2, (0, 0, 0))
+        server = self._sprites["server"][sprite_status(
+            self.state._playerStatus)][frame]
         self.window_surface.blit(
-            server, (player_row[0] * self.cell_size, player_col[0] * self.cell_size))
+            server, (player_col * self.cell_size, player_row * self.cell_size))
 
         if self.render_mode == "human":
             pygame.event.pump()
@@ -241,14 +270,55 @@ class TableServerEnv(gym.Env):
         else:  # rgb_array
             return np.transpose(np.array(pygame.surfarray.array3d(self.window_surface)), axes=(1, 0, 2))
 
+    def _load_sprites(self):
+        pygame = import_pygame()
+        cell = (self.cell_size, self.cell_size)
+
+        def load(path):
+            return pygame.transform.scale(pygame.image.load(path).convert_alpha(), cell)
+
+        background_sprite = pygame.image.load(background_sprite_path).convert()
+        background_sprite = pygame.transform.scale(
+            background_sprite, self.window_size)
+        background_sprite.set_colorkey((0, 0, 0))
+
+        # every walking frame of every server sheet, indexed [playerStatus][frame]
+        server_sprites = []
+        for path in [server_no_food_sheet_path, server_table_1_sheet_path,
+                     server_table_2_sheet_path, server_table_3_sheet_path]:
+            sprite_sheet = pygame.image.load(path).convert_alpha()
+            server_sprites.append([get_image(sprite_sheet, frame, 32, 32, 2, (0, 0, 0))
+                                   for frame in range(4)])
+
+        self._sprites = {
+            "background": background_sprite,
+            "wall": load(wall_sprite_path),
+            "kitchen": load(kitchen_sprite_sheet_path),
+            "table": load(table_unserved_sprite_path),
+            "served": [load(table1_served_path), load(table2_served_path), load(table3_served_path)],
+            "server": server_sprites,
+        }
+
+    def _draw_static_surface(self):
+        pygame = import_pygame()
+        self._static_surface = pygame.Surface(self.window_size)
+        self._static_surface.blit(self._sprites["background"], (0, 0))
+        walls = np.where(self.layout.walls)
+        for i in range(len(walls[0])):
+            self._static_surface.blit(
+                self._sprites["wall"], (walls[1][i] * self.cell_size, walls[0][i] * self.cell_size))
+        self._static_surface = self._static_surface.convert()
+
     def close(self):
         if self.window_surface is not None:
+            pygame = import_pygame()
             pygame.display.quit()
             pygame.quit()
         return
 
 
 def get_image(sheet, frame, width, height, scale, color):
+    pygame = import_pygame()
     image = pygame.Surface((width, height)).convert_alpha()
     image.blit(sheet, (0, 0), ((frame*width), 0, width, height))
     image = pygame.transform.scale(image, (width * scale, height * scale))
@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+
+import numpy as np
+from table_server.envs.table_server_model import TableServerState, get_layout
+from table_server.envs.table_server_renderer import TableServerRenderer, write_png
+
+
+class TableServerExporter:
+    """
+    Renders whole episodes to rgb_array frames without a window or a frame
+    rate, into one memory-mapped .npy stack or a directory of png images.
+    An episode is a dict with the kitchen_meals and table_spawns of its
+    start configuration and its actions, like TableServerReplay.episode
+    gives, and has len(actions) + 1 frames drawn like the human mode of
+    the env draws them. Episodes are split over worker processes that each
+    build the renderer once.
+    """
+
+    def __init__(self, height=5, width=7, tables=3, meals=3, layout_seed=None, cell_size=64, workers=1):
+        self.options = dict(height=height, width=width, tables=tables, meals=meals,
+                            layout_seed=layout_seed, cell_size=cell_size)
+        self.workers = workers
+        self.frame_shape = (height * cell_size, width * cell_size, 3)
+
+    @classmethod
+    def from_replay(cls, replay, cell_size=64, workers=1):
+        """
+        Exporter for the layout of a TableServerReplay
+        """
+        return cls(replay.height, replay.width, replay.tables, replay.meals,
+                   replay.layout_seed, cell_size, workers)
+
+    @staticmethod
+    def episode(state, actions):
+        """
+        Episode dict of a plan played from state
+        """
+        return {"kitchen_meals": np.array(state._kitchen_meals),
+                "table_spawns": np.array(state._table_spawns),
+                "actions": np.asarray(actions, dtype=np.int64)}
+
+    def offsets(self, episodes):
+        """
+        Index of the first frame of every episode and, last, the frame count
+        """
+        return np.concatenate([[0], np.cumsum([len(episode["actions"]) + 1 for episode in episodes])])
+
+    def to_npy(self, episodes, path):
+        """
+        Write the frames of every episode one after the other into a
+        (frames, height, width, 3) uint8 .npy file at path, allocated up
+        front. Returns the offsets of the episodes.
+        """
+        offsets = self.offsets(episodes)
+        stack = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8,
+                                          shape=(int(offsets[-1]),) + self.frame_shape)
+        del stack
+        tasks = [(episode, ("npy", path, int(offset))) for episode, offset in zip(episodes, offsets)]
+        self._run(tasks)
+        return offsets
+
+    def to_images(self, episodes, directory, name="episode_{:05d}_frame_{:04d}.png"):
+        """
+        Write every frame as a png into directory, named by name formatted
+        with the episode and frame index
+        """
+        os.makedirs(directory, exist_ok=True)
+        tasks = [(episode, ("png", os.path.join(directory, name), i)) for i, episode in enumerate(episodes)]
+        self._run(tasks)
+
+    def _run(self, tasks):
+        if self.workers <= 1:
+            _init_worker(self.options)
+            for task in tasks:
+                _export_episode(task)
+            return
+        chunksize = max(1, len(tasks) // (self.workers * 4))
+        with multiprocessing.Pool(self.workers, _init_worker, (self.options,)) as pool:
+            for _ in pool.imap_unordered(_export_episode, tasks, chunksize):
+                pass
+
+
+# every pool worker builds its own renderer once and maps a .npy stack once
+_worker = None
+
+
+def _init_worker(options):
+    global _worker
+    options = dict(options)
+    cell_size = options.pop("cell_size")
+    layout_seed = options.pop("layout_seed")
+    _worker = {"options": options,
+               "layout": get_layout(options["height"], options["width"], options["tables"], layout_seed),
+               "renderer": TableServerRenderer(options["height"], options["width"], cell_size),
+               "stacks": {}}
+
+
+def _export_episode(task):
+    episode, (kind, path, index) = task
+    state = TableServerState(kitchen_meals=episode["kitchen_meals"], table_spawns=episode["table_spawns"],
+                             layout=_worker["layout"], **_worker["options"])
+    renderer = _worker["renderer"]
+    if kind == "npy":
+        if path not in _worker["stacks"]:
+            _worker["stacks"][path] = np.load(path, mmap_mode="r+")
+        stack = _worker["stacks"][path]
+        frames = stack[index:index + len(episode["actions"]) + 1]
+    else:
+        frames = np.empty((len(episode["actions"]) + 1,) + renderer.frame_shape, dtype=np.uint8)
+
+    renderer.render(state, out=frames[0])
+    last_action = None
+    for i, action in enumerate(episode["actions"]):
+        action = int(action)
+        state.step(action)
+        # the human mode passes the action drawn before as the last action
+        renderer.render(state, action, last_action, out=frames[i + 1])
+        last_action = action
+
+    if kind == "npy":
+        frames.flush()
+    else:
+        for frame, image in enumerate(frames):
+            write_png(path.format(index, frame), image)
@@ -1,7 +1,9 @@
 import numpy as np
-import copy
 import enum
+import hashlib
 import random
+import string
+from collections import deque
 
 
 class AreaIndex(enum.IntEnum):
@@ -30,71 +32,323 @@ class ActionIndex(enum.IntEnum):
     SERVE_MEAL = 5
 
 
+# cells the three tables are shuffled between
+TABLE_SPAWNS = np.array([[2, 0], [0, 4], [2, 6]])
+
+# row and column change of the move actions
+MOVES = {ActionIndex.UP: (-1, 0), ActionIndex.DOWN: (1, 0),
+         ActionIndex.LEFT: (0, -1), ActionIndex.RIGHT: (0, 1)}
+
+# legal action list of every 6-bit action mask
+ACTION_LISTS = tuple(tuple(action for action in range(len(ActionIndex)) if bits >> action & 1)
+                     for bits in range(1 << len(ActionIndex)))
+
+# how tables are printed in the text rendering
+TABLE_CHARS = string.digits[1:] + string.ascii_letters
+
+
+class DistanceTable:
+    """
+    Shortest walking distances around the walls of one layout. The distance
+    map from a cell is a breadth first search over the non-wall cells, made
+    the first time that cell is asked for and kept for every later state.
+    """
+
+    def __init__(self, walls):
+        self._walls = walls
+        self._maps = {}
+
+    def distances_from(self, row, col):
+        """
+        (height, width) array of steps from (row, col), -1 where unreachable
+        """
+        source = (int(row), int(col))
+        if source in self._maps:
+            return self._maps[source]
+        height, width = self._walls.shape
+        distances = np.full((height, width), -1, dtype=np.int32)
+        distances[source] = 0
+        queue = deque([source])
+        while queue:
+            row, col = queue.popleft()
+            step = distances[row][col] + 1
+            for next_row, next_col in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+                if 0 <= next_row < height and 0 <= next_col < width and \
+                        distances[next_row][next_col] < 0 and not self._walls[next_row][next_col]:
+                    distances[next_row][next_col] = step
+                    queue.append((next_row, next_col))
+        self._maps[source] = distances
+        return distances
+
+    def distance(self, start, target):
+        return int(self.distances_from(*target)[start[0]][start[1]])
+
+
+# one distance table per wall layout, shared by every state on it
+_distance_tables = {}
+
+
+def distance_table(area):
+    walls = area == AreaIndex.WALL
+    key = (walls.shape, walls.tobytes())
+    if key not in _distance_tables:
+        _distance_tables[key] = DistanceTable(walls)
+    return _distance_tables[key]
+
+
+def table_index(table):
+    """
+    Area value of table (0 based). The first three tables are TABLE1-3,
+    later ones are numbered on after SERVER
+    """
+    if table < 3:
+        return AreaIndex.TABLE1 + table
+    return AreaIndex.SERVER + table - 2
+
+
+def area_high(tables):
+    """
+    Highest value an area cell can hold with this many tables
+    """
+    return max(int(AreaIndex.SERVER), int(table_index(tables - 1)))
+
+
+# area value -> table (0 based) or -1, one lookup per number of tables
+_table_lookups = {}
+
+
+def table_lookup(tables):
+    if tables not in _table_lookups:
+        lookup = np.full((area_high(tables) + 1,), -1, dtype=np.int64)
+        for table in range(tables):
+            lookup[table_index(table)] = table
+        _table_lookups[tables] = lookup
+    return _table_lookups[tables]
+
+
+def layout_key(walls, kitchen_pos):
+    """
+    Tells layouts apart in keys that outlive the process, like plan stores:
+    the size, the kitchen and a digest of the walls
+    """
+    height, width = walls.shape
+    return "{}x{}:{}.{}:{}".format(
+        height, width, int(kitchen_pos[0]), int(kitchen_pos[1]),
+        hashlib.blake2b(np.packbits(walls).tobytes(), digest_size=8).hexdigest())
+
+
+class TableServerLayout:
+    """
+    The parts of a restaurant that never change during an episode: walls,
+    the server spawn, the kitchen and the cells the tables are shuffled
+    between. States share their layout, so it is built and checked once.
+    """
+
+    def __init__(self, walls, server_spawn, kitchen_pos, table_spawns):
+        self.walls = np.asarray(walls, dtype=bool)
+        self.height, self.width = self.walls.shape
+        self.server_spawn = (int(server_spawn[0]), int(server_spawn[1]))
+        self.kitchen_pos = (int(kitchen_pos[0]), int(kitchen_pos[1]))
+        self.table_spawns = np.array(table_spawns, dtype=np.int64).reshape(-1, 2)
+        self.tables = len(self.table_spawns)
+
+        # walls and kitchen, tables and server are drawn on per state
+        self.base_area = np.where(
+            self.walls, AreaIndex.WALL, AreaIndex.EMPTY).astype(np.int32)
+        self.base_area[self.kitchen_pos] = AreaIndex.KITCHEN
+        self.distances = distance_table(self.base_area)
+
+        # legal actions of every cell, [row, col, holding a meal] -> 6 bools
+        free = ~np.pad(self.walls, 1, constant_values=True)
+        self.action_masks = np.zeros(
+            (self.height, self.width, 2, len(ActionIndex)), dtype=bool)
+        self.action_masks[:, :, :, ActionIndex.UP] = free[:-2, 1:-1, None]
+        self.action_masks[:, :, :, ActionIndex.DOWN] = free[2:, 1:-1, None]
+        self.action_masks[:, :, :, ActionIndex.LEFT] = free[1:-1, :-2, None]
+        self.action_masks[:, :, :, ActionIndex.RIGHT] = free[1:-1, 2:, None]
+        self.action_masks[self.kitchen_pos][0][ActionIndex.PICK_UP_MEAL] = True
+        self.action_masks[:, :, 1, ActionIndex.SERVE_MEAL] = True
+        self.action_masks.setflags(write=False)
+        # the same as 6-bit ints, bit i set when action i is legal
+        self.action_bits = (self.action_masks << np.arange(len(ActionIndex))).sum(
+            axis=-1).astype(np.uint8)
+        self.key = layout_key(self.walls, self.kitchen_pos)
+
+    @classmethod
+    def default(cls):
+        """
+        The original 5x7 restaurant with three tables
+        """
+        walls = np.zeros((5, 7), dtype=bool)
+        for row, col in [(3, 0), (3, 1), (3, 3), (3, 4), (3, 5), (3, 6), (0, 3), (1, 3), (1, 6)]:
+            walls[row][col] = True
+        return cls(walls, (4, 3), (4, 6), TABLE_SPAWNS).validate()
+
+    @classmethod
+    def generate(cls, height, width, tables, seed=None, wall_density=0.2):
+        """
+        Random layout of height x width with tables tables. Walls are short
+        straight runs like the default layout, free cells that end up cut
+        off from the largest open region are walled in, and the server,
+        kitchen and tables are placed on distinct cells of that region.
+        """
+        if height * width < tables + 2:
+            raise ValueError("a {}x{} layout has no room for {} tables".format(
+                height, width, tables))
+        rng = np.random.default_rng(seed)
+
+        for _ in range(100):
+            walls = np.zeros((height, width), dtype=bool)
+            target = int(wall_density * height * width)
+            longest = max(2, min(height, width) // 2)
+            while walls.sum() < target:
+                row, col = rng.integers(height), rng.integers(width)
+                length = rng.integers(1, longest + 1)
+                if rng.random() < 0.5:
+                    walls[row, col:col + length] = True
+                else:
+                    walls[row:row + length, col] = True
+
+            # keep the largest open region, every free cell is then reachable
+            region = None
+            unseen = ~walls
+            while unseen.any():
+                cell = divmod(int(np.flatnonzero(unseen)[0]), width)
+                reachable = DistanceTable(walls).distances_from(*cell) >= 0
+                unseen &= ~reachable
+                if region is None or reachable.sum() > region.sum():
+                    region = reachable
+            if region is None or region.sum() < tables + 2:
+                continue
+
+            cells = rng.choice(np.flatnonzero(region), tables + 2, replace=False)
+            spawns = np.stack(np.divmod(cells, width), axis=1)
+            return cls(~region, spawns[0], spawns[1], spawns[2:]).validate()
+        raise ValueError("could not fit {} tables in a {}x{} layout".format(
+            tables, height, width))
+
+    def validate(self):
+        """
+        Raise ValueError unless the kitchen and every table can be walked
+        to from the server spawn, all on distinct free cells
+        """
+        cells = [self.server_spawn, self.kitchen_pos] + \
+            [(int(row), int(col)) for row, col in self.table_spawns]
+        if len(set(cells)) != len(cells):
+            raise ValueError("server, kitchen and tables need distinct cells")
+        reachable = self.distances.distances_from(*self.server_spawn)
+        for row, col in cells:
+            if not (0 <= row < self.height and 0 <= col < self.width) or reachable[row][col] < 0:
+                raise ValueError("cell ({}, {}) can not be reached from the server spawn".format(
+                    row, col))
+        return self
+
+
+# layouts by (height, width, tables, seed), shared by every state on them
+_layouts = {}
+
+
+def get_layout(height=5, width=7, tables=3, seed=None):
+    """
+    The default layout for the default size without a seed, otherwise a
+    generated one (seed 0 when none is given)
+    """
+    key = (height, width, tables, seed)
+    if key not in _layouts:
+        if seed is None and (height, width, tables) == (5, 7, 3):
+            _layouts[key] = TableServerLayout.default()
+        else:
+            _layouts[key] = TableServerLayout.generate(
+                height, width, tables, 0 if seed is None else seed)
+    return _layouts[key]
+
+
+def start_configuration(layout, meals, rng=None):
+    """
+    (kitchen_meals, table_spawns) of a new episode on layout drawn from rng,
+    a np.random.Generator, or from a fresh unseeded one when not given
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    kitchen_meals = rng.permutation(
+        np.arange(1, layout.tables + 1, dtype=np.int32))[:meals]
+    table_spawns = rng.permutation(layout.table_spawns)
+    return kitchen_meals, table_spawns
+
+
+def start_configurations(seeds, height=5, width=7, tables=3, meals=3, layout_seed=None):
+    """
+    (len(seeds), meals) kitchen queues and (len(seeds), tables, 2) table
+    spawns, row i is where reset(seed=seeds[i]) of an env with this layout
+    starts. A seed gives the same start in any process, so sweeps can be
+    split into shards of seeds.
+    """
+    layout = get_layout(height, width, tables, layout_seed)
+    kitchen_meals = np.zeros((len(seeds), meals), dtype=np.int32)
+    table_spawns = np.zeros((len(seeds), tables, 2), dtype=np.int64)
+    for i, seed in enumerate(seeds):
+        kitchen_meals[i], table_spawns[i] = start_configuration(
+            layout, meals, np.random.default_rng(seed))
+    return kitchen_meals, table_spawns
+
+
 class TableServerState:
 
-    def __init__(self, height=5, width=7, tables=3, meals=3):
-        self._height = height
-        self._width = width
-        self._tables = tables
+    def __init__(self, height=5, width=7, tables=3, meals=3, kitchen_meals=None, table_spawns=None, layout=None,
+                 rng=None):
+        if meals > tables:
+            raise ValueError("every meal goes to its own table, {} meals is more than {} tables".format(
+                meals, tables))
+        if layout is None:
+            layout = get_layout(height, width, tables)
+        self._layout = layout
+        self._height = layout.height
+        self._width = layout.width
+        self._tables = layout.tables
         self._meals = meals
-        self._area = np.zeros((height, width), dtype=np.int32)
+        self._walls = layout.walls
+        self._distances = layout.distances
+        self._kitchen_pos = layout.kitchen_pos
 
         # int to represent what table meal the player is holding
         self._playerStatus = 0
 
-        # 0 = empty, 1 = got meal
-        self._table_status = np.zeros((3,), dtype=np.int32)
-
-        self._kitchen_meals = np.array([1, 2, 3], dtype=np.int32)
-        self._kitchen_meals = np.random.permutation(self._kitchen_meals)
-
-        self._table_spawns = np.array([[2, 0], [0, 4], [2, 6]])
-        self._table_spawns = np.random.permutation(self._table_spawns)
-        self._table_1_spawn = self._table_spawns[0]
-        self._table_2_spawn = self._table_spawns[1]
-        self._table_3_spawn = self._table_spawns[2]
-
-        # spawn walls
-        self._area[3][0] = AreaIndex.WALL
-        self._area[3][1] = AreaIndex.WALL
-        self._area[3][3] = AreaIndex.WALL
-        self._area[3][4] = AreaIndex.WALL
-        self._area[3][5] = AreaIndex.WALL
-        self._area[3][6] = AreaIndex.WALL
-        self._area[0][3] = AreaIndex.WALL
-        self._area[1][3] = AreaIndex.WALL
-        self._area[1][6] = AreaIndex.WALL
+        # a start configuration can be given (decoding), otherwise it is
+        # drawn from rng
+        if kitchen_meals is None or table_spawns is None:
+            drawn_meals, drawn_spawns = start_configuration(layout, meals, rng)
+            if kitchen_meals is None:
+                kitchen_meals = drawn_meals
+            if table_spawns is None:
+                table_spawns = drawn_spawns
+        self._kitchen_meals = np.array(kitchen_meals, dtype=np.int32)
+
+        # 0 = empty, 1 = got meal, tables that ordered nothing count as served
+        self._table_status = np.ones((self._tables,), dtype=np.int32)
+        self._table_status[self._kitchen_meals - 1] = 0
+        # orders are counted from here, see FIRST_GOAL_TEST and SECOND_GOAL_TEST
+        self._start_queued = self._kitchen_meals.size
+        self._start_served = int(self._table_status.sum())
+
+        self._table_spawns = np.array(table_spawns, dtype=np.int64)
+        self._place_fixtures()
 
         # spawn server
-        self._area[4][3] = AreaIndex.SERVER
-
-        # spawn kitchen
-        self._area[4][6] = AreaIndex.KITCHEN
-
-        # self._area[table_spawns[0][0]][table_spawns[0][1]] = AreaIndex.TABLE1
-        # self._area[table_spawns[1][0]
-        #            ][table_spawns[1][1]] = AreaIndex.TABLE2
-        # self._area[table_spawns[2][0]
-        #            ][table_spawns[2][1]] = AreaIndex.TABLE3
-
-        # randomize table spawns
-        self._area[self._table_1_spawn[0]
-                   ][self._table_1_spawn[1]] = AreaIndex.TABLE1
-        self._area[self._table_2_spawn[0]
-                   ][self._table_2_spawn[1]] = AreaIndex.TABLE2
-        self._area[self._table_3_spawn[0]
-                   ][self._table_3_spawn[1]] = AreaIndex.TABLE3
+        self._player_pos = layout.server_spawn
 
-        # DEBUG
-
-        self._restaurant = {
-            "area": self._area,
-            "playerStatus": self._playerStatus,
-            "kitchen_meals": self._kitchen_meals,
-            "table_status": self._table_status,
-        }
+        # the area is drawn the first time it is asked for
+        self._area = None
         return
 
+    def _place_fixtures(self):
+        # what the server uncovers when it walks off a cell
+        self._table_at = {}
+        self._fixtures = {self._kitchen_pos: AreaIndex.KITCHEN}
+        for table, (table_row, table_col) in enumerate(self._table_spawns):
+            cell = (int(table_row), int(table_col))
+            self._table_at[cell] = table
+            self._fixtures[cell] = table_index(table)
+
     @property
     def height(self):
         return self._height
@@ -111,14 +365,38 @@ class TableServerState:
     def meals(self):
         return self._meals
 
-    def randomize(self, seed=None):
-        if seed is not None:
-            np.random.seed(seed)
-        self._area = np.random.randint(
+    @property
+    def layout(self):
+        return self._layout
+
+    @property
+    def area(self):
+        if self._area is None:
+            area = self._layout.base_area.copy()
+            for cell, value in self._fixtures.items():
+                area[cell] = value
+            area[self._player_pos] = AreaIndex.SERVER
+            self._area = area
+        return self._area
+
+    def randomize(self, seed=None, rng=None):
+        if rng is None:
+            rng = np.random.default_rng(seed)
+        self._area = rng.integers(
             0, AreaIndex.SERVER, size=(self._height, self._width), dtype=np.int32)
         self._playerStatus = 0
         return self
 
+    def _move(self, row, col):
+        if row < 0 or row >= self._height or col < 0 or col >= self._width or self._walls[row][col]:
+            return
+        # only a drawn area needs the two changed cells updated
+        if self._area is not None:
+            self._area[self._player_pos] = self._fixtures.get(
+                self._player_pos, AreaIndex.EMPTY)
+            self._area[row][col] = AreaIndex.SERVER
+        self._player_pos = (row, col)
+
     def turn(self, action):
         """
         UP = 0
@@ -127,115 +405,192 @@ class TableServerState:
         RIGHT = 3
         PICK_UP_MEAL = 4
         SERVE_MEAL = 5
+
+        Returns True when a meal was served
         """
-        player_row, player_col = np.where(self._area == AreaIndex.SERVER)
-        player_row, player_col = player_row[0], player_col[0]
+        player_row, player_col = self._player_pos
 
         # move to area
-        if action == ActionIndex.UP:
-            if player_row == 0 or self._area[player_row - 1][player_col] == AreaIndex.WALL:
-                return
-            else:
-                self._area[player_row][player_col] = AreaIndex.EMPTY
-                self._area[player_row - 1][player_col] = AreaIndex.SERVER
-        elif action == ActionIndex.DOWN:
-            if player_row == self._height - 1 or self._area[player_row + 1][player_col] == AreaIndex.WALL:
-                return
-            else:
-                self._area[player_row][player_col] = AreaIndex.EMPTY
-                self._area[player_row + 1][player_col] = AreaIndex.SERVER
-        elif action == ActionIndex.LEFT:
-            if player_col == 0 or self._area[player_row][player_col - 1] == AreaIndex.WALL:
-                return
-            else:
-                self._area[player_row][player_col] = AreaIndex.EMPTY
-                self._area[player_row][player_col - 1] = AreaIndex.SERVER
-        elif action == ActionIndex.RIGHT:
-            if player_col == self._width - 1 or self._area[player_row][player_col + 1] == AreaIndex.WALL:
-                return
-            else:
-                self._area[player_row][player_col] = AreaIndex.EMPTY
-                self._area[player_row][player_col + 1] = AreaIndex.SERVER
+        move = MOVES.get(action)
+        if move is not None:
+            self._move(player_row + move[0], player_col + move[1])
 
         # pick up meal
-        if action == ActionIndex.PICK_UP_MEAL:
-            if self._area[player_row][player_col] == self._area[4][6] and self._playerStatus == PlayerIndex.NONE.value and len(self._kitchen_meals) > 0:
+        elif action == ActionIndex.PICK_UP_MEAL:
+            if self._player_pos == self._kitchen_pos and self._playerStatus == PlayerIndex.NONE.value and len(self._kitchen_meals) > 0:
                 meal = self._kitchen_meals[0]
-                self._kitchen_meals = np.delete(self._kitchen_meals, 0)
-                self._playerStatus = meal
+                self._kitchen_meals = self._kitchen_meals[1:]
+                self._playerStatus = int(meal)
 
         # serve meal
-        if action == ActionIndex.SERVE_MEAL:
-            if self._area[self._table_1_spawn[0]][self._table_1_spawn[1]] == AreaIndex.SERVER and self._playerStatus == PlayerIndex.MEAL1.value:
-                self._table_status[0] = 1
+        elif action == ActionIndex.SERVE_MEAL:
+            table = self._table_at.get(self._player_pos)
+            if table is not None and self._playerStatus == table + 1:
+                self._table_status = self._table_status.copy()
+                self._table_status[table] = 1
                 self._playerStatus = PlayerIndex.NONE.value
+                return True
+        return False
 
-            elif self._area[self._table_2_spawn[0]][self._table_2_spawn[1]] == AreaIndex.SERVER and self._playerStatus == PlayerIndex.MEAL2.value:
-                self._table_status[1] = 1
-                self._playerStatus = PlayerIndex.NONE.value
+    def step(self, action):
+        """
+        turn in place and return (STEP_COST, GOAL_TEST) of the transition,
+        for envs that have no use for the state before it
+        """
+        served = self.turn(action)
+        terminated = self._playerStatus == PlayerIndex.NONE.value and \
+            self._kitchen_meals.size == 0 and bool(self._table_status.all())
+        return (0 if served else 1), terminated
 
-            elif self._area[self._table_3_spawn[0]][self._table_3_spawn[1]] == AreaIndex.SERVER and self._playerStatus == PlayerIndex.MEAL3.value:
-                self._table_status[2] = 1
-                self._playerStatus = PlayerIndex.NONE.value
+    @classmethod
+    def from_observation(cls, observation):
+        """
+        Wrap an observation dict in a state without re-running the layout code,
+        the arrays are shared with the observation
+        """
+        state = cls.__new__(cls)
+        area = observation["area"]
+        state._height, state._width = area.shape
+        state._tables = observation["table_status"].size
+        state._area = area
+        state._playerStatus = observation["playerStatus"]
+        state._kitchen_meals = observation["kitchen_meals"]
+        state._table_status = observation["table_status"]
+        # an observation does not tell which served tables ordered, so meals
+        # are the ones still owed and orders are counted from here
+        state._start_queued = state._kitchen_meals.size
+        state._start_served = int(state._table_status.sum())
+        state._meals = state._tables - state._start_served
+
+        # a table or kitchen the server is standing on is hidden under it
+        flat = area.ravel()
+        server_cell = int(np.flatnonzero(flat == AreaIndex.SERVER)[0])
+        state._player_pos = divmod(server_cell, state._width)
+        kitchen_cell = np.flatnonzero(flat == AreaIndex.KITCHEN)
+        if kitchen_cell.size > 0:
+            state._kitchen_pos = divmod(int(kitchen_cell[0]), state._width)
+        else:
+            state._kitchen_pos = state._player_pos
+        table_cells = np.full((state._tables,), server_cell)
+        table_of = table_lookup(state._tables)[flat]
+        found = np.flatnonzero(table_of >= 0)
+        table_cells[table_of[found]] = found
+        state._table_spawns = np.stack(
+            np.divmod(table_cells, state._width), axis=1)
+
+        state._layout = TableServerLayout(
+            area == AreaIndex.WALL, state._player_pos, state._kitchen_pos, state._table_spawns)
+        state._walls = state._layout.walls
+        state._distances = state._layout.distances
+        state._place_fixtures()
+        return state
+
+    def copy(self):
+        """
+        Cheap successor copy: the layout is shared, turn replaces the meal
+        and table arrays instead of writing to them and the area is only
+        drawn again when the copy is observed
+        """
+        state = self.__class__.__new__(self.__class__)
+        state.__dict__.update(self.__dict__)
+        state._area = None
+        return state
 
-            else:
-                return
-
-        # reset table and kitchen after moves after player moves off of them
-        if not self._area[4][6] == AreaIndex.SERVER:
-            self._area[4][6] = AreaIndex.KITCHEN
-
-        if self._area[self._table_1_spawn[0]][self._table_1_spawn[1]] != AreaIndex.SERVER:
-            self._area[self._table_1_spawn[0]
-                       ][self._table_1_spawn[1]] = AreaIndex.TABLE1
-        if self._area[self._table_2_spawn[0]][self._table_2_spawn[1]] != AreaIndex.SERVER:
-            self._area[self._table_2_spawn[0]
-                       ][self._table_2_spawn[1]] = AreaIndex.TABLE2
-        if self._area[self._table_3_spawn[0]][self._table_3_spawn[1]] != AreaIndex.SERVER:
-            self._area[self._table_3_spawn[0]
-                       ][self._table_3_spawn[1]] = AreaIndex.TABLE3
-
-        # set new restaurant state
-        self._restaurant = {
-            "area": self._area,
+    def encode(self):
+        """
+        Pack the state into a single int, see encode_observation
+        """
+        cells = self._height * self._width
+        tables = self._tables
+        code = (self._player_pos[0] * self._width + self._player_pos[1]) * \
+            (tables + 1) + int(self._playerStatus)
+        kitchen_meals = self._kitchen_meals
+        for i in range(tables):
+            meal = int(kitchen_meals[i]) if i < kitchen_meals.size else 0
+            code = code * (tables + 1) + meal
+        for bit in self._table_status:
+            code = code * 2 + int(bit)
+        for table_row, table_col in self._table_spawns:
+            code = code * cells + int(table_row) * self._width + int(table_col)
+        return code
+
+    @classmethod
+    def decode(cls, code, height=5, width=7, tables=3, meals=3, layout=None):
+        """
+        Build the state packed into code by encode
+        """
+        cells = height * width
+        table_cells = []
+        for _ in range(tables):
+            code, cell = divmod(code, cells)
+            table_cells.append(cell)
+        table_cells.reverse()
+        table_status = []
+        for _ in range(tables):
+            code, bit = divmod(code, 2)
+            table_status.append(bit)
+        table_status.reverse()
+        kitchen_meals = []
+        for _ in range(tables):
+            code, meal = divmod(code, tables + 1)
+            if meal != 0:
+                kitchen_meals.append(meal)
+        kitchen_meals.reverse()
+        server_cell, player_status = divmod(code, tables + 1)
+
+        table_spawns = [divmod(cell, width) for cell in table_cells]
+        state = cls(height, width, tables, meals, kitchen_meals=kitchen_meals,
+                    table_spawns=table_spawns, layout=layout)
+        state._table_status[:] = table_status
+        state._playerStatus = player_status
+        state._player_pos = divmod(server_cell, width)
+        # a packed state does not keep its start, orders are counted from
+        # the start of the episode
+        state._start_queued = meals
+        state._start_served = tables - meals
+        return state
+
+    @property
+    def observation(self):
+        return {
+            "area": self.area,
             "playerStatus": self._playerStatus,
             "kitchen_meals": self._kitchen_meals,
             "table_status": self._table_status,
         }
 
-    @property
-    def observation(self):
-        return self._restaurant
-
     @observation.setter
     def observation(self, value):
-        self._restaurant = value
-        self._area = value["area"]
-        self._height = value["area"].shape[0]
-        self._width = value["area"].shape[1]
-        self._tables = 3
-        self._meals = 3
+        self.__dict__.update(TableServerState.from_observation(value).__dict__)
         return
 
+    @property
+    def order(self):
+        """
+        The observation without the area, which is all the goal tests need
+        """
+        return {
+            "playerStatus": self._playerStatus,
+            "kitchen_meals": self._kitchen_meals,
+            "table_status": self._table_status,
+        }
+
     def __str__(self):
         s = ""
         grid = ""
+        area = self.area
         for row in range(0, self.height):
             for col in range(0, self.width):
-                if self._area[row][col] == AreaIndex.EMPTY:
+                if area[row][col] == AreaIndex.EMPTY:
                     grid += ". "
-                elif self._area[row][col] == AreaIndex.TABLE1:
-                    grid += "1 "
-                elif self._area[row][col] == AreaIndex.TABLE2:
-                    grid += "2 "
-                elif self._area[row][col] == AreaIndex.TABLE3:
-                    grid += "3 "
-                elif self._area[row][col] == AreaIndex.KITCHEN:
+                elif area[row][col] == AreaIndex.KITCHEN:
                     grid += "K "
-                elif self._area[row][col] == AreaIndex.WALL:
+                elif area[row][col] == AreaIndex.WALL:
                     grid += "W "
-                elif self._area[row][col] == AreaIndex.SERVER:
+                elif area[row][col] == AreaIndex.SERVER:
                     grid += "S "
+                else:
+                    grid += TABLE_CHARS[table_lookup(self._tables)[area[row][col]]] + " "
             grid += "\n"
 
         s += "Area:\n"
@@ -246,95 +601,143 @@ class TableServerState:
         return s
 
 
-class TableServerModel:
+def packed_state(code, layout=None, meals=3):
+    """
+    State of a packed int on layout, the default layout when None. A code
+    packed on another grid would decode into a state of the wrong size or
+    with tables off their spawns, so it raises instead.
+    """
+    if layout is None:
+        layout = get_layout()
+    height, width, tables = layout.height, layout.width, layout.tables
+    cells = height * width
+    if 0 <= code < cells * (tables + 1) ** (tables + 1) * 2 ** tables * cells ** tables:
+        state = TableServerState.decode(code, height, width, tables, meals, layout)
+        player_row, player_col = state._player_pos
+        table_cells = sorted(int(row) * width + int(col) for row, col in state._table_spawns)
+        if table_cells == sorted(int(row) * width + int(col) for row, col in layout.table_spawns) and \
+                not layout.walls[player_row, player_col]:
+            return state
+    raise ValueError(
+        "{} is not a packed state of the {}x{} layout with {} tables, use a "
+        "TableServerLayoutModel of the layout it was packed on".format(code, height, width, tables))
+
+
+def encode_observation(observation):
+    """
+    Pack an observation into a single int, most significant first:
+    server cell, held meal, kitchen queue (one base tables + 1 digit per
+    table, 0 = empty), table status bits and the cell of every table.
+    Equal states always give equal codes, so the code can key search dicts.
+    """
+    area = observation["area"]
+    height, width = area.shape
+    cells = height * width
+    flat = area.ravel()
+    tables = observation["table_status"].size
 
-    def ACTIONS(state):
-        statePointer = None
-        if type(state) != dict:
-            statePointer = state.observation
-        else:
-            statePointer = state
-        actions = [ActionIndex.UP.value, ActionIndex.DOWN.value,
-                   ActionIndex.LEFT.value, ActionIndex.RIGHT.value,
-                   ActionIndex.PICK_UP_MEAL.value, ActionIndex.SERVE_MEAL.value]
+    server_cell = int(np.flatnonzero(flat == AreaIndex.SERVER)[0])
+    code = server_cell * (tables + 1) + int(observation["playerStatus"])
 
-        # find player
-        player_row, player_col = np.where(
-            statePointer["area"] == AreaIndex.SERVER.value)
+    kitchen_meals = observation["kitchen_meals"]
+    for i in range(tables):
+        meal = int(kitchen_meals[i]) if i < kitchen_meals.size else 0
+        code = code * (tables + 1) + meal
 
-        # can't serve meal if player is not holding a meal
-        if statePointer["playerStatus"] == PlayerIndex.NONE.value:
-            actions.remove(ActionIndex.SERVE_MEAL.value)
+    for bit in observation["table_status"]:
+        code = code * 2 + int(bit)
 
-        # can't pick up meal if player is already holding a meal
-        if statePointer["playerStatus"] != PlayerIndex.NONE.value or statePointer["area"][4][6] != AreaIndex.SERVER.value:
-            actions.remove(ActionIndex.PICK_UP_MEAL.value)
+    # a table the server is standing on is hidden under it
+    table_cells = np.full((tables,), server_cell)
+    table_of = table_lookup(tables)[flat]
+    found = np.flatnonzero(table_of >= 0)
+    table_cells[table_of[found]] = found
+    for table_cell in table_cells:
+        code = code * cells + int(table_cell)
+    return code
 
-        # can't move up if player is at the top of the map or if there is a wall above
-        if player_row == 0:
-            actions.remove(ActionIndex.UP.value)
-        else:
-            if statePointer["area"][player_row - 1][0][player_col] == AreaIndex.WALL.value:
-                actions.remove(ActionIndex.UP.value)
 
-        if player_col == 0 or statePointer["area"][player_row][0][player_col - 1] == AreaIndex.WALL.value:
-            actions.remove(ActionIndex.LEFT.value)
+class TableServerModel:
 
-        if player_row == statePointer["area"].shape[0] - 1 or statePointer["area"][player_row + 1][0][player_col] == AreaIndex.WALL.value:
-            actions.remove(ActionIndex.DOWN.value)
+    def ENCODE(state):
+        if isinstance(state, (int, np.integer)):
+            return int(state)
+        if type(state) != dict:
+            return state.encode()
+        return encode_observation(state)
 
-        if player_col == statePointer["area"].shape[1] - 1 or statePointer["area"][player_row][0][player_col + 1] == AreaIndex.WALL.value:
-            actions.remove(ActionIndex.RIGHT.value)
+    def ACTIONS(state):
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
+        if type(state) == dict:
+            state = TableServerState.from_observation(state)
+        player_row, player_col = state._player_pos
+        bits = state._layout.action_bits[player_row, player_col,
+                                         int(state._playerStatus != PlayerIndex.NONE.value)]
+        return list(ACTION_LISTS[bits])
+
+    def ACTION_MASK(state):
+        """
+        Read-only bool array of the 6 actions, True where legal. A single
+        lookup in the layout's table of every cell: moves are legal unless
+        a wall or the edge is in the way, picking up only on the kitchen
+        with free hands and serving only with a meal in hand.
+        """
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
+        if type(state) == dict:
+            state = TableServerState.from_observation(state)
+        player_row, player_col = state._player_pos
+        return state._layout.action_masks[player_row, player_col,
+                                          int(state._playerStatus != PlayerIndex.NONE.value)]
 
-        return actions
+    def ACTION_MASKS(states):
+        """
+        (len(states), 6) bool array with the ACTION_MASK of every state,
+        one gather when the states share a layout
+        """
+        states = [packed_state(state) if isinstance(state, (int, np.integer)) else
+                  TableServerState.from_observation(state) if type(state) == dict else state
+                  for state in states]
+        if len(states) == 0:
+            return np.zeros((0, len(ActionIndex)), dtype=bool)
+        layout = states[0]._layout
+        if any(state._layout is not layout for state in states):
+            return np.array([TableServerModel.ACTION_MASK(state) for state in states])
+        positions = np.array([state._player_pos for state in states])
+        holding = np.array([state._playerStatus != PlayerIndex.NONE.value for state in states],
+                           dtype=np.int64)
+        return layout.action_masks[positions[:, 0], positions[:, 1], holding]
 
     def RESULT(state, action):
         statePointer = None
 
+        # packed states give back packed states
+        if isinstance(state, (int, np.integer)):
+            state_prime = packed_state(state)
+            state_prime.turn(action)
+            return state_prime.encode()
+
         if type(state) == dict:
-            statePointer = TableServerState()
-            statePointer._restaurant = state
-            statePointer._area = state["area"]
-            statePointer._playerStatus = state["playerStatus"]
-            statePointer._kitchen_meals = state["kitchen_meals"]
-            statePointer._table_status = state["table_status"]
-            statePointer.observation = state
-            statePointer._height = state["area"].shape[0]
-            statePointer._width = state["area"].shape[1]
-
-            table_1_spawn = np.where(
-                statePointer._area == AreaIndex.TABLE1.value)
-            table_2_spawn = np.where(
-                statePointer._area == AreaIndex.TABLE2.value)
-            table_3_spawn = np.where(
-                statePointer._area == AreaIndex.TABLE3.value)
-
-            statePointer._table_1_spawn = np.array(
-                [table_1_spawn[0][0], table_1_spawn[1][0]])
-            statePointer._table_2_spawn = np.array(
-                [table_2_spawn[0][0], table_2_spawn[1][0]])
-            statePointer._table_3_spawn = np.array(
-                [table_3_spawn[0][0], table_3_spawn[1][0]])
+            statePointer = TableServerState.from_observation(state)
         else:
             statePointer = state
 
-        state_prime = copy.deepcopy(statePointer)
+        state_prime = statePointer.copy()
         state_prime.turn(action)
         return state_prime
 
     def GOAL_TEST(state):
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
         goal_test = True
 
         if type(state) != dict:
-            statePointer = state.observation
+            statePointer = state.order
         else:
             statePointer = state
 
-        if statePointer["table_status"][0] == 0:
-            goal_test = False
-        if statePointer["table_status"][1] == 0:
-            goal_test = False
-        if statePointer["table_status"][2] == 0:
+        if not statePointer["table_status"].all():
             goal_test = False
         if statePointer["kitchen_meals"].size > 0:
             goal_test = False
@@ -348,14 +751,14 @@ class TableServerModel:
         return goal_test
 
     def FIRST_GOAL_TEST(state):
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
+        if type(state) == dict:
+            state = TableServerState.from_observation(state)
         goal_test = True
 
-        if type(state) != dict:
-            statePointer = state.observation
-        else:
-            statePointer = state
-
-        if statePointer["kitchen_meals"].size > 2:
+        # a meal has been picked up since the start
+        if state._kitchen_meals.size >= state._start_queued:
             goal_test = False
 
         # if goal_test:
@@ -365,14 +768,14 @@ class TableServerModel:
         return goal_test
 
     def SECOND_GOAL_TEST(state):
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
+        if type(state) == dict:
+            state = TableServerState.from_observation(state)
         goal_test = True
 
-        if type(state) != dict:
-            statePointer = state.observation
-        else:
-            statePointer = state
-
-        if np.array_equal(statePointer["table_status"], np.array([0, 0, 0])):
+        # a table has been served since the start
+        if state._table_status.sum() <= state._start_served:
             goal_test = False
 
         # if goal_test:
@@ -381,10 +784,12 @@ class TableServerModel:
         return goal_test
 
     def THIRD_GOAL_TEST(state):
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
         goal_test = True
 
         if type(state) != dict:
-            statePointer = state.observation
+            statePointer = state.order
         else:
             statePointer = state
 
@@ -401,24 +806,29 @@ class TableServerModel:
     reward system is set up so the lower the cost, the better
     """
     def STEP_COST(state, action, state_prime):
-        if action == ActionIndex.PICK_UP_MEAL.value and state._restaurant["playerStatus"] == PlayerIndex.NONE.value:
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
+        if type(state) == dict:
+            state = TableServerState.from_observation(state)
+        if isinstance(state_prime, (int, np.integer)):
+            state_prime = packed_state(state_prime)
+        if type(state_prime) == dict:
+            state_prime = TableServerState.from_observation(state_prime)
+        if action == ActionIndex.PICK_UP_MEAL.value and state._playerStatus == PlayerIndex.NONE.value:
             return 1
 
-        elif action == ActionIndex.PICK_UP_MEAL.value and state._restaurant["playerStatus"] != PlayerIndex.NONE.value:
+        elif action == ActionIndex.PICK_UP_MEAL.value and state._playerStatus != PlayerIndex.NONE.value:
             return 1
 
         elif action == ActionIndex.UP.value or action == ActionIndex.DOWN.value or action == ActionIndex.LEFT.value or action == ActionIndex.RIGHT.value:
             return 1
 
-        elif action == ActionIndex.SERVE_MEAL.value and state._restaurant["playerStatus"] == PlayerIndex.NONE.value:
+        elif action == ActionIndex.SERVE_MEAL.value and state._playerStatus == PlayerIndex.NONE.value:
             return 1
 
-        elif action == ActionIndex.SERVE_MEAL.value and state._restaurant["playerStatus"] != PlayerIndex.NONE.value:
-            if state._restaurant["table_status"][0] == 0 and state_prime._restaurant["table_status"][0] == 1 and state._restaurant["playerStatus"] == PlayerIndex.MEAL1.value:
-                return 0
-            elif state._restaurant["table_status"][1] == 0 and state_prime._restaurant["table_status"][1] == 1 and state._restaurant["playerStatus"] == PlayerIndex.MEAL2.value:
-                return 0
-            elif state._restaurant["table_status"][2] == 0 and state_prime._restaurant["table_status"][2] == 1 and state._restaurant["playerStatus"] == PlayerIndex.MEAL3.value:
+        elif action == ActionIndex.SERVE_MEAL.value and state._playerStatus != PlayerIndex.NONE.value:
+            table = state._playerStatus - 1
+            if state._table_status[table] == 0 and state_prime._table_status[table] == 1:
                 return 0
             else:
                 return 1
@@ -430,38 +840,109 @@ class TableServerModel:
     #     return 0
 
     def HEURISTIC(state):
-        if type(state) != dict:
-            statePointer = state.observation
-        else:
-            statePointer = state
-        player_row, player_col = np.where(
-            statePointer["area"] == AreaIndex.SERVER)
-        kitchen_row, kitchen_col = np.where(
-            statePointer["area"] == AreaIndex.KITCHEN)
-        table_1_row, table_1_col = np.where(
-            statePointer["area"] == AreaIndex.TABLE1)
-        table_2_row, table_2_col = np.where(
-            statePointer["area"] == AreaIndex.TABLE2)
-        table_3_row, table_3_col = np.where(
-            statePointer["area"] == AreaIndex.TABLE3)
-        manhattan_distance = 0
-
-        if kitchen_col.size == 0 or table_1_col.size == 0 or table_2_col.size == 0 or table_3_col.size == 0:
+        """
+        Exact cost of the rest of the order: the held meal goes to its table,
+        then every queued meal is a walk to the kitchen, a pick up and a walk
+        to its table, with walking distances around the walls. Serving is
+        free, so this never overestimates and is consistent with STEP_COST.
+        """
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
+        if type(state) == dict:
+            state = TableServerState.from_observation(state)
+        distances = state._distances
+        position = state._player_pos
+        cost = 0
+
+        if state._playerStatus != PlayerIndex.NONE.value:
+            table = state._table_spawns[state._playerStatus - 1]
+            cost += distances.distance(position, table)
+            position = table
+
+        for meal in state._kitchen_meals:
+            table = state._table_spawns[meal - 1]
+            cost += distances.distance(position, state._kitchen_pos) + 1 + \
+                distances.distance(state._kitchen_pos, table)
+            position = table
+        return cost
+
+    def MANHATTAN_HEURISTIC(state):
+        if isinstance(state, (int, np.integer)):
+            state = packed_state(state)
+        if type(state) == dict:
+            state = TableServerState.from_observation(state)
+        player_row, player_col = state._player_pos
+
+        # standing on the kitchen or a table counts as being there
+        if state._player_pos == state._kitchen_pos:
             return 0
+        for table_row, table_col in state._table_spawns:
+            if player_row == table_row and player_col == table_col:
+                return 0
+
+        if state._playerStatus == PlayerIndex.NONE.value:
+            target_row, target_col = state._kitchen_pos
+        else:
+            target_row, target_col = state._table_spawns[state._playerStatus - 1]
+        manhattan_distance = abs(player_row - target_row) + \
+            abs(player_col - target_col)
+        return int(manhattan_distance)
+
+
+class TableServerLayoutModel:
+    """
+    TableServerModel bound to one layout and meal count, for packed int
+    states of generated layouts. Ints are decoded on the bound layout and
+    RESULT gives ints back, observations and TableServerStates are passed
+    on unchanged.
+    """
+
+    def __init__(self, layout=None, meals=3):
+        self.layout = get_layout() if layout is None else layout
+        self.meals = meals
+
+    def STATE(self, state):
+        if isinstance(state, (int, np.integer)):
+            return packed_state(int(state), self.layout, self.meals)
+        return state
+
+    def ENCODE(self, state):
+        return TableServerModel.ENCODE(state)
+
+    def ACTIONS(self, state):
+        return TableServerModel.ACTIONS(self.STATE(state))
+
+    def ACTION_MASK(self, state):
+        return TableServerModel.ACTION_MASK(self.STATE(state))
+
+    def ACTION_MASKS(self, states):
+        return TableServerModel.ACTION_MASKS([self.STATE(state) for state in states])
+
+    def RESULT(self, state, action):
+        if isinstance(state, (int, np.integer)):
+            return TableServerModel.RESULT(self.STATE(state), action).encode()
+        return TableServerModel.RESULT(state, action)
+
+    def STEP_COST(self, state, action, state_prime):
+        return TableServerModel.STEP_COST(self.STATE(state), action, self.STATE(state_prime))
+
+    def GOAL_TEST(self, state):
+        return TableServerModel.GOAL_TEST(self.STATE(state))
+
+    def FIRST_GOAL_TEST(self, state):
+        return TableServerModel.FIRST_GOAL_TEST(self.STATE(state))
+
+    def SECOND_GOAL_TEST(self, state):
+        return TableServerModel.SECOND_GOAL_TEST(self.STATE(state))
+
+    def THIRD_GOAL_TEST(self, state):
+        return TableServerModel.THIRD_GOAL_TEST(self.STATE(state))
+
+    def HEURISTIC(self, state):
+        return TableServerModel.HEURISTIC(self.STATE(state))
 
-        if statePointer["playerStatus"] == PlayerIndex.NONE.value:
-            manhattan_distance = abs(
-                player_row[0] - kitchen_row[0]) + abs(player_col[0] - kitchen_col[0])
-        elif statePointer["playerStatus"] == PlayerIndex.MEAL1.value:
-            manhattan_distance = abs(
-                player_row[0] - table_1_row[0]) + abs(player_col[0] - table_1_col[0])
-        elif statePointer["playerStatus"] == PlayerIndex.MEAL2.value:
-            manhattan_distance = abs(
-                player_row[0] - table_2_row[0]) + abs(player_col[0] - table_2_col[0])
-        elif statePointer["playerStatus"] == PlayerIndex.MEAL3.value:
-            manhattan_distance = abs(
-                player_row[0] - table_3_row[0]) + abs(player_col[0] - table_3_col[0])
-        return manhattan_distance
+    def MANHATTAN_HEURISTIC(self, state):
+        return TableServerModel.MANHATTAN_HEURISTIC(self.STATE(state))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+import numpy as np
+from gymnasium import spaces
+from table_server.envs.table_server_model import AreaIndex, area_high
+
+
+class TableServerObservation:
+    """
+    Fixed-shape 1-D encoding of a state, written into a preallocated buffer.
+
+    "flat":   the area, the held meal, the kitchen queue padded with 0 to
+              meals slots and the table bits, as plain values
+    "onehot": wall, kitchen, server and one plane per table over the grid,
+              the held meal one-hot, one one-hot of tables + 1 values per
+              queue slot (0 = empty) and the table bits
+
+    The onehot planes come first, planes() gives them as a (C, H, W) view.
+    """
+
+    MODES = ("flat", "onehot")
+
+    def __init__(self, height=5, width=7, tables=3, meals=3, mode="flat", dtype=np.float32):
+        if mode not in self.MODES:
+            raise ValueError("observation mode must be one of {}, not {}".format(
+                self.MODES, mode))
+        self.height = height
+        self.width = width
+        self.tables = tables
+        self.meals = meals
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+
+        cells = height * width
+        if mode == "flat":
+            self.channels = 0
+            self._held = cells
+            self._queue = self._held + 1
+            self._bits = self._queue + meals
+            high = np.full((self._bits + tables,), area_high(tables))
+            high[self._held:self._bits] = tables
+        else:
+            # wall, kitchen, server, then one plane per table
+            self.channels = 3 + tables
+            self._held = self.channels * cells
+            self._queue = self._held + tables + 1
+            self._bits = self._queue + meals * (tables + 1)
+            self._slots = self._queue + np.arange(meals) * (tables + 1)
+            high = np.ones((self._bits + tables,))
+        high[self._bits:] = 1
+        self.size = self._bits + tables
+        self.shape = (self.size,)
+        self.space = spaces.Box(low=0, high=high.astype(self.dtype), shape=self.shape,
+                                dtype=self.dtype)
+
+    def buffer(self):
+        return np.zeros(self.shape, dtype=self.dtype)
+
+    def check(self, out):
+        if out.shape != self.shape or out.dtype != self.dtype:
+            raise ValueError("observation buffer must be {} {}, not {} {}".format(
+                self.shape, self.dtype, out.shape, out.dtype))
+        return out
+
+    def planes(self, observation):
+        """
+        (channels, height, width) view of the onehot planes of observation
+        """
+        return observation[..., :self._held].reshape(
+            observation.shape[:-1] + (self.channels, self.height, self.width))
+
+    def _cell(self, row, col):
+        return row * self.width + col
+
+    def write(self, state, out=None):
+        """
+        Write all of state into out, allocated when not given
+        """
+        if out is None:
+            out = self.buffer()
+        out[:] = 0
+        if self.mode == "flat":
+            out[:self._held] = state.area.ravel()
+        else:
+            cells = self.height * self.width
+            out[:cells] = state.layout.walls.ravel()
+            out[cells + self._cell(*state._kitchen_pos)] = 1
+            out[2 * cells + self._cell(*state._player_pos)] = 1
+            for table, (table_row, table_col) in enumerate(state._table_spawns):
+                out[(3 + table) * cells + self._cell(table_row, table_col)] = 1
+        self._write_order(state, out)
+        return out
+
+    def update(self, state, out, previous_pos):
+        """
+        Bring out, written for the state before the last turn, up to date
+        with state. Only the cells the server left and entered and the
+        order are written.
+        """
+        if previous_pos != state._player_pos:
+            old_cell = self._cell(*previous_pos)
+            new_cell = self._cell(*state._player_pos)
+            if self.mode == "flat":
+                out[old_cell] = state._fixtures.get(
+                    previous_pos, AreaIndex.EMPTY)
+                out[new_cell] = AreaIndex.SERVER
+            else:
+                server = 2 * self.height * self.width
+                out[server + old_cell] = 0
+                out[server + new_cell] = 1
+        self._write_order(state, out)
+        return out
+
+    def _write_order(self, state, out):
+        kitchen_meals = state._kitchen_meals
+        if self.mode == "flat":
+            out[self._held] = state._playerStatus
+            out[self._queue:self._bits] = 0
+            out[self._queue:self._queue + kitchen_meals.size] = kitchen_meals
+        else:
+            queued = kitchen_meals.size
+            out[self._held:self._bits] = 0
+            out[self._held + int(state._playerStatus)] = 1
+            out[self._slots[:queued] + kitchen_meals] = 1
+            out[self._slots[queued:]] = 1
+        out[self._bits:] = state._table_status
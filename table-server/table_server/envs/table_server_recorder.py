@@ -0,0 +1,173 @@
+import os
+import struct
+
+import gymnasium as gym
+import numpy as np
+from table_server.envs.table_server_model import TableServerState, get_layout
+
+# magic, version, height, width, tables, meals, layout seed (-1 = default)
+LOG_HEADER = struct.Struct("<4sBHHHHi")
+MAGIC = b"TSRL"
+VERSION = 1
+# steps of an episode, followed by the kitchen queue (meals x uint16), the
+# layout spawn of every table (tables x uint16) and one byte per step
+EPISODE_HEADER = struct.Struct("<I")
+
+# bits of a step byte
+ACTION_BITS = 0b111
+REWARD_BIT = 3
+TERMINATED_BIT = 4
+TRUNCATED_BIT = 5
+
+
+def log_header(height, width, tables, meals, layout_seed):
+    return LOG_HEADER.pack(MAGIC, VERSION, height, width, tables, meals,
+                           -1 if layout_seed is None else layout_seed)
+
+
+class TableServerRecorder(gym.Wrapper):
+    """
+    Appends every episode of a TableServerEnv to a binary log: the start
+    configuration, then one byte per step with the action, reward,
+    terminated and truncated bits. Steps are collected in memory and an
+    episode is written with one append when it terminates or is truncated,
+    or else when the next reset or close ends it, so workers of one run can
+    share a log. TableServerReplay reads it.
+    """
+
+    def __init__(self, env, path):
+        super().__init__(env)
+        base = env.unwrapped
+        self.path = path
+        self._header = log_header(base.height, base.width, base.tables, base.meals,
+                                  base.layout_seed)
+        # index of every table spawn of the layout by its cell
+        self._spawn_index = {tuple(int(x) for x in spawn): i
+                             for i, spawn in enumerate(base.layout.table_spawns)}
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            os.write(self._fd, self._header)
+        else:
+            with open(path, "rb") as f:
+                header = f.read(LOG_HEADER.size)
+            if header != self._header:
+                os.close(self._fd)
+                raise ValueError("{} records a different layout or format".format(path))
+        self._start = None
+        self._steps = bytearray()
+
+    def reset(self, **kwargs):
+        self._write_episode()
+        observation, info = self.env.reset(**kwargs)
+        state = self.env.unwrapped.state
+        spawns = [self._spawn_index[(int(row), int(col))] for row, col in state._table_spawns]
+        self._start = (np.asarray(state._kitchen_meals, dtype=np.uint16).tobytes() +
+                       np.asarray(spawns, dtype=np.uint16).tobytes())
+        return observation, info
+
+    def step(self, action):
+        observation, reward, terminated, truncated, info = self.env.step(action)
+        self._steps.append(action | reward << REWARD_BIT |
+                           terminated << TERMINATED_BIT | truncated << TRUNCATED_BIT)
+        if terminated or truncated:
+            self._write_episode()
+        return observation, reward, terminated, truncated, info
+
+    def _write_episode(self):
+        if self._start is not None and self._steps:
+            os.write(self._fd, EPISODE_HEADER.pack(len(self._steps)) + self._start + bytes(self._steps))
+        self._start = None
+        self._steps = bytearray()
+
+    def close(self):
+        if self._fd is not None:
+            self._write_episode()
+            os.close(self._fd)
+            self._fd = None
+        super().close()
+
+
+class TableServerReplay:
+    """
+    Memory-mapped view of a log written by TableServerRecorder. Episodes
+    are found by one walk over the record headers, their steps are read
+    from the map when asked for and states are rebuilt from the start
+    configuration without any search. An episode cut short by a crash at
+    the end of the log is left out.
+    """
+
+    def __init__(self, path):
+        self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, height, width, tables, meals, layout_seed = LOG_HEADER.unpack_from(self._data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a table-server log".format(path))
+        self.height, self.width = height, width
+        self.tables, self.meals = tables, meals
+        self.layout_seed = None if layout_seed < 0 else layout_seed
+        self.layout = get_layout(height, width, tables, self.layout_seed)
+
+        start_size = 2 * (meals + tables)
+        offsets = []
+        offset = LOG_HEADER.size
+        while offset + EPISODE_HEADER.size <= self._data.size:
+            steps, = EPISODE_HEADER.unpack_from(self._data, offset)
+            end = offset + EPISODE_HEADER.size + start_size + steps
+            if end > self._data.size:
+                break
+            offsets.append(offset)
+            offset = end
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._start_size = start_size
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _record(self, episode):
+        offset = int(self._offsets[episode]) + EPISODE_HEADER.size
+        steps, = EPISODE_HEADER.unpack_from(self._data, self._offsets[episode])
+        start = self._data[offset:offset + self._start_size].view(np.uint16)
+        return start, self._data[offset + self._start_size:offset + self._start_size + steps]
+
+    def episode(self, episode):
+        """
+        Dict with the start configuration and the per step arrays of an episode
+        """
+        start, steps = self._record(episode)
+        return {
+            "kitchen_meals": start[:self.meals].astype(np.int32),
+            "table_spawns": self.layout.table_spawns[start[self.meals:]],
+            "actions": steps & ACTION_BITS,
+            "rewards": (steps >> REWARD_BIT) & 1,
+            "terminated": ((steps >> TERMINATED_BIT) & 1).astype(bool),
+            "truncated": ((steps >> TRUNCATED_BIT) & 1).astype(bool),
+        }
+
+    def start_state(self, episode):
+        start, _ = self._record(episode)
+        return TableServerState(self.height, self.width, self.tables, self.meals,
+                                kitchen_meals=start[:self.meals],
+                                table_spawns=self.layout.table_spawns[start[self.meals:]],
+                                layout=self.layout)
+
+    def state(self, episode, step):
+        """
+        State of episode after step steps, 0 is the start state
+        """
+        state = self.start_state(episode)
+        for action in self._record(episode)[1][:step]:
+            state.step(int(action) & ACTION_BITS)
+        return state
+
+    def states(self, episode):
+        """
+        Yield a copy of every state of episode, from the start state on
+        """
+        state = self.start_state(episode)
+        yield state.copy()
+        for action in self._record(episode)[1]:
+            state.step(int(action) & ACTION_BITS)
+            yield state.copy()
+
+    def close(self):
+        # the map is closed when the last array viewing it goes away
+        self._data = None
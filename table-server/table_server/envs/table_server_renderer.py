@@ -0,0 +1,250 @@
+import numpy as np
+import struct
+import zlib
+from functools import lru_cache
+from importlib import resources
+from table_server.envs.table_server_model import ActionIndex, PlayerIndex
+
+
+def asset_path(name):
+    """
+    Path of a sprite in the imgs directory of the installed package, so it
+    resolves from any working directory
+    """
+    return str(resources.files("table_server.envs").joinpath("imgs").joinpath(name))
+
+
+def read_png(path):
+    """
+    Decode an 8-bit, non-interlaced RGB or RGBA png into a (height, width, 4) uint8 array
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("{} is not a png".format(path))
+
+    i = 8
+    idat = b""
+    while i < len(data):
+        length, chunk = struct.unpack(">I4s", data[i:i + 8])
+        body = data[i + 8:i + 8 + length]
+        if chunk == b"IHDR":
+            width, height, depth, color_type, _, _, interlace = struct.unpack(
+                ">IIBBBBB", body)
+        elif chunk == b"IDAT":
+            idat += body
+        elif chunk == b"IEND":
+            break
+        i += 12 + length
+    if depth != 8 or color_type not in (2, 6) or interlace != 0:
+        raise ValueError("{} is not an 8-bit non-interlaced RGB(A) png".format(path))
+
+    channels = 4 if color_type == 6 else 3
+    stride = width * channels
+    raw = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(
+        height, stride + 1)
+    pixels = np.zeros((height, stride), dtype=np.uint8)
+    previous = np.zeros((stride,), dtype=np.uint8)
+    for row in range(height):
+        line = raw[row, 1:].astype(np.int32)
+        kind = raw[row, 0]
+        up = previous.astype(np.int32)
+        if kind == 1:  # sub
+            line = line.reshape(width, channels).cumsum(axis=0).ravel()
+        elif kind == 2:  # up
+            line = line + up
+        elif kind in (3, 4):  # average, paeth
+            for x in range(stride):
+                left = line[x - channels] if x >= channels else 0
+                if kind == 3:
+                    line[x] = (line[x] + (left + up[x]) // 2) & 0xFF
+                    continue
+                up_left = up[x - channels] if x >= channels else 0
+                p = left + up[x] - up_left
+                pa, pb, pc = abs(p - left), abs(p - up[x]), abs(p - up_left)
+                if pa <= pb and pa <= pc:
+                    predictor = left
+                elif pb <= pc:
+                    predictor = up[x]
+                else:
+                    predictor = up_left
+                line[x] = (line[x] + predictor) & 0xFF
+        pixels[row] = line & 0xFF
+        previous = pixels[row]
+
+    image = np.full((height, width, 4), 255, dtype=np.uint8)
+    image[:, :, :channels] = pixels.reshape(height, width, channels)
+    return image
+
+
+@lru_cache(maxsize=None)
+def load_png(name):
+    """
+    A sprite decoded by read_png once per process, read-only
+    """
+    image = read_png(asset_path(name))
+    image.setflags(write=False)
+    return image
+
+
+def write_png(path, image):
+    """
+    Encode a (height, width, 3) uint8 array as an 8-bit RGB png without filters
+    """
+    height, width, _ = image.shape
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(kind, body):
+        return (struct.pack(">I", len(body)) + kind + body +
+                struct.pack(">I", zlib.crc32(kind + body) & 0xFFFFFFFF))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def stretch_indices(source, size):
+    """
+    Source index of every destination pixel, the same nearest pixel walk
+    pygame.transform.scale does
+    """
+    indices = np.empty((size,), dtype=np.int64)
+    error = 2 * source - 2 * size
+    index = 0
+    for i in range(size):
+        indices[i] = index
+        while error >= 0:
+            index += 1
+            error -= 2 * size
+        error += 2 * source
+    return indices
+
+
+def scale_image(image, width, height):
+    rows = stretch_indices(image.shape[0], height)
+    cols = stretch_indices(image.shape[1], width)
+    return image[rows[:, None], cols[None, :]]
+
+
+def sprite_status(player_status):
+    """
+    Server sheet for the held meal, there are sheets for three meals so
+    later meals reuse them in turn
+    """
+    if player_status == PlayerIndex.NONE:
+        return 0
+    return (player_status - 1) % 3 + 1
+
+
+def server_frame(action, last_action=None):
+    """
+    Walking frame of the server sprite sheets for the last move
+    """
+    if action is None or action > ActionIndex.RIGHT:
+        action = last_action
+    if action == ActionIndex.UP:
+        return 2
+    elif action == ActionIndex.LEFT:
+        return 3
+    elif action == ActionIndex.RIGHT:
+        return 1
+    return 0
+
+
+class TableServerRenderer:
+    """
+    Draws rgb_array frames with NumPy only. Sprites are decoded and scaled
+    once into (cell, cell, 3) color and (cell, cell, 1) alpha tiles, frames
+    are assembled by slicing into an output buffer and match the pygame
+    renderer pixel for pixel.
+    """
+
+    def __init__(self, height=5, width=7, cell_size=64):
+        self.height = height
+        self.width = width
+        self.cell_size = cell_size
+        self.frame_shape = (height * cell_size, width * cell_size, 3)
+        self._static = {}
+
+        def tile(name):
+            image = scale_image(load_png(name), cell_size, cell_size).astype(np.int32)
+            return image[:, :, :3], image[:, :, 3:]
+
+        # the background is drawn without alpha
+        background = load_png("background.png")
+        self._background = scale_image(
+            background, self.frame_shape[1], self.frame_shape[0])[:, :, :3]
+
+        self._wall = tile("barrel.png")
+        self._kitchen = tile("kitchen.png")
+        self._table = tile("table.png")
+        self._served = [tile("table_1.png"), tile(
+            "table_2.png"), tile("table_3.png")]
+
+        # server frames are cut onto black and then keyed on black
+        self._server = []
+        for status in range(4):
+            sheet = load_png("server_{}.png".format(status))
+            frames = []
+            for frame in range(4):
+                image = sheet[:32, frame * 32:(frame + 1) * 32].astype(np.int32)
+                color = image[:, :, :3] * (image[:, :, 3:] == 255)
+                color = scale_image(color, cell_size, cell_size)
+                alpha = np.where(color.any(axis=2, keepdims=True), 255, 0)
+                frames.append((color, alpha))
+            self._server.append(frames)
+
+    def _blit(self, out, sprite, row, col):
+        color, alpha = sprite
+        cell = self.cell_size
+        region = out[row * cell:(row + 1) * cell, col * cell:(col + 1) * cell]
+        below = region.astype(np.int32)
+        region[:] = below + (((color - below) * alpha + color) >> 8)
+
+    def _static_frame(self, walls):
+        key = walls.tobytes()
+        if key not in self._static:
+            static = self._background.copy()
+            for row, col in zip(*np.nonzero(walls)):
+                self._blit(static, self._wall, row, col)
+            self._static[key] = static
+        return self._static[key]
+
+    def render(self, state, action=None, last_action=None, out=None):
+        """
+        Draw state into out, a (height * cell, width * cell, 3) uint8 array
+        that is allocated when not given
+        """
+        if out is None:
+            out = np.empty(self.frame_shape, dtype=np.uint8)
+        out[:] = self._static_frame(state.layout.walls)
+
+        player_pos = state._player_pos
+        if player_pos != state._kitchen_pos:
+            self._blit(out, self._kitchen, *state._kitchen_pos)
+        for table, (table_row, table_col) in enumerate(state._table_spawns):
+            if player_pos == (table_row, table_col):
+                continue
+            if state._table_status[table] == 0:
+                self._blit(out, self._table, table_row, table_col)
+            else:
+                self._blit(out, self._served[table % 3], table_row, table_col)
+
+        frame = server_frame(action, last_action)
+        self._blit(out, self._server[sprite_status(
+            state._playerStatus)][frame], *player_pos)
+        return out
+
+    def render_batch(self, states, actions=None, out=None):
+        """
+        Draw many states into out, a (len(states), height * cell, width * cell, 3) array
+        """
+        if out is None:
+            out = np.empty((len(states),) + self.frame_shape, dtype=np.uint8)
+        for i, state in enumerate(states):
+            action = None if actions is None else actions[i]
+            self.render(state, action, out=out[i])
+        return out
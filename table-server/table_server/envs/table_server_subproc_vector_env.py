@@ -0,0 +1,279 @@
+import ctypes
+import multiprocessing
+import os
+import traceback
+
+import numpy as np
+from gymnasium import spaces
+from gymnasium.vector import VectorEnv, AutoresetMode
+from gymnasium.vector.utils import batch_space
+from table_server.envs.table_server_env import TableServerEnv
+from table_server.envs.table_server_model import area_high
+from table_server.envs.table_server_observation import TableServerObservation
+
+# one byte commands, a worker answers OK or ERROR followed by a traceback
+STEP = b"s"
+RESET = b"r"
+CLOSE = b"c"
+OK = b"k"
+ERROR = b"e"
+
+
+def _block_fields(num_envs, height, width, tables, meals, observation_mode, observation_dtype):
+    """
+    (name, shape, dtype) of every array kept in the shared block
+    """
+    fields = [
+        ("actions", (num_envs,), np.int64),
+        # seed of the next reset of every env, -1 = unseeded
+        ("seeds", (num_envs,), np.int64),
+        ("reset_mask", (num_envs,), np.bool_),
+        ("rewards", (num_envs,), np.int64),
+        ("terminated", (num_envs,), np.bool_),
+        ("truncated", (num_envs,), np.bool_),
+        ("action_mask", (num_envs, 6), np.bool_),
+    ]
+    if observation_mode == "dict":
+        fields += [
+            ("area", (num_envs, height, width), np.int32),
+            ("playerStatus", (num_envs,), np.int64),
+            ("kitchen_meals", (num_envs, meals), np.int32),
+            ("table_status", (num_envs, tables), np.int32),
+        ]
+    else:
+        encoder = TableServerObservation(height, width, tables, meals, observation_mode, observation_dtype)
+        fields.append(("observation", (num_envs,) + encoder.shape, encoder.dtype))
+    return fields
+
+
+def _block_size(fields):
+    size = 0
+    for _, shape, dtype in fields:
+        # every array starts 8 byte aligned
+        size += -size % 8 + int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return size
+
+
+def _block_views(block, fields):
+    """
+    numpy views of the arrays in the shared block
+    """
+    buffer = np.frombuffer(block, dtype=np.uint8)
+    views = {}
+    offset = 0
+    for name, shape, dtype in fields:
+        offset += -offset % 8
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        views[name] = buffer[offset:offset + nbytes].view(dtype).reshape(shape)
+        offset += nbytes
+    return views
+
+
+def _worker(start, stop, env_options, max_episode_steps, block, fields, pipe, parent_pipe):
+    parent_pipe.close()
+    views = _block_views(block, fields)
+    observation_mode = env_options["observation_mode"]
+    envs = []
+    for i in range(start, stop):
+        options = dict(env_options, copy_observation=False)
+        if observation_mode != "dict":
+            # flat and onehot observations are written straight into the block
+            options["observation_buffer"] = views["observation"][i]
+        envs.append(TableServerEnv(**options))
+    steps = np.zeros((stop - start,), dtype=np.int64)
+    autoreset = np.zeros((stop - start,), dtype=bool)
+
+    def write(i, observation, info):
+        views["action_mask"][i] = info["action_mask"]
+        if observation_mode == "dict":
+            views["area"][i] = observation["area"]
+            views["playerStatus"][i] = observation["playerStatus"]
+            kitchen_meals = observation["kitchen_meals"]
+            views["kitchen_meals"][i, :kitchen_meals.size] = kitchen_meals
+            views["kitchen_meals"][i, kitchen_meals.size:] = 0
+            views["table_status"][i] = observation["table_status"]
+
+    def reset(j, i):
+        seed = int(views["seeds"][i])
+        observation, info = envs[j].reset(seed=None if seed < 0 else seed)
+        steps[j] = 0
+        autoreset[j] = False
+        views["rewards"][i] = 0
+        views["terminated"][i] = False
+        views["truncated"][i] = False
+        write(i, observation, info)
+
+    while True:
+        try:
+            command = pipe.recv_bytes()
+        except EOFError:
+            break
+        try:
+            if command == STEP:
+                for j, i in enumerate(range(start, stop)):
+                    if autoreset[j]:
+                        views["seeds"][i] = -1
+                        reset(j, i)
+                        continue
+                    observation, reward, terminated, _, info = envs[j].step(views["actions"][i])
+                    steps[j] += 1
+                    truncated = not terminated and steps[j] >= max_episode_steps
+                    views["rewards"][i] = reward
+                    views["terminated"][i] = terminated
+                    views["truncated"][i] = truncated
+                    autoreset[j] = terminated or truncated
+                    write(i, observation, info)
+            elif command == RESET:
+                for j, i in enumerate(range(start, stop)):
+                    if views["reset_mask"][i]:
+                        reset(j, i)
+            elif command == CLOSE:
+                pipe.send_bytes(OK)
+                break
+            pipe.send_bytes(OK)
+        except Exception:
+            pipe.send_bytes(ERROR + traceback.format_exc().encode())
+    for env in envs:
+        env.close()
+    pipe.close()
+
+
+class TableServerSubprocVectorEnv(VectorEnv):
+    """
+    num_envs TableServerEnvs split over worker processes that share one
+    memory block with the parent. Actions, seeds, observations, rewards,
+    done flags and action masks are arrays in the block, so a step sends
+    one command byte to every worker and waits for one byte back. Finished
+    restaurants reset on the next step, like TableServerVectorEnv.
+
+    observation_mode "dict" gives batched dicts with kitchen_meals padded
+    with 0, "flat" and "onehot" are written by the envs straight into the
+    block without copies.
+    """
+
+    metadata = {"autoreset_mode": AutoresetMode.NEXT_STEP}
+
+    def __init__(self, num_envs=1, max_episode_steps=80, render_mode=None,
+                 height=5, width=7, tables=3, meals=3, layout_seed=None,
+                 observation_mode="dict", observation_dtype=np.float32,
+                 num_workers=None, context=None, copy=True, **kwargs):
+        if render_mode is not None:
+            raise ValueError("the envs of worker processes do not render")
+        if meals > tables:
+            raise ValueError("every meal goes to its own table, {} meals is more than {} tables".format(
+                meals, tables))
+        self.num_envs = num_envs
+        self.max_episode_steps = max_episode_steps
+        self.render_mode = render_mode
+        self.observation_mode = observation_mode
+        # observations stay in the block until the next step when False
+        self.copy = copy
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self.num_workers = max(1, min(num_workers, num_envs))
+
+        self.single_action_space = spaces.Discrete(6)
+        if observation_mode == "dict":
+            self.single_observation_space = spaces.Dict(
+                {
+                    "area": spaces.Box(low=0, high=area_high(tables), shape=(height, width), dtype=np.int32),
+                    "playerStatus": spaces.Discrete(tables + 1),
+                    "kitchen_meals": spaces.Box(low=0, high=tables, shape=(meals,), dtype=np.int32),
+                    "table_status": spaces.Box(low=0, high=1, shape=(tables,), dtype=np.int32),
+                }
+            )
+        else:
+            self.single_observation_space = TableServerObservation(
+                height, width, tables, meals, observation_mode, observation_dtype).space
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.observation_space = batch_space(self.single_observation_space, num_envs)
+
+        fields = _block_fields(num_envs, height, width, tables, meals,
+                               observation_mode, observation_dtype)
+        context = multiprocessing.get_context(context)
+        self._block = context.RawArray(ctypes.c_uint8, _block_size(fields))
+        self._views = _block_views(self._block, fields)
+        env_options = dict(height=height, width=width, tables=tables, meals=meals,
+                           layout_seed=layout_seed, observation_mode=observation_mode,
+                           observation_dtype=observation_dtype)
+
+        # contiguous slices of envs, as even as possible
+        bounds = np.linspace(0, num_envs, self.num_workers + 1).astype(int)
+        self._pipes = []
+        self._processes = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            parent_pipe, child_pipe = context.Pipe()
+            process = context.Process(
+                target=_worker, daemon=True,
+                args=(int(start), int(stop), env_options, max_episode_steps,
+                      self._block, fields, child_pipe, parent_pipe))
+            process.start()
+            child_pipe.close()
+            self._pipes.append(parent_pipe)
+            self._processes.append(process)
+        self.closed = False
+
+    def _command(self, command):
+        for pipe in self._pipes:
+            pipe.send_bytes(command)
+        errors = []
+        for pipe in self._pipes:
+            answer = pipe.recv_bytes()
+            if answer != OK:
+                errors.append(answer[len(ERROR):].decode())
+        if errors:
+            raise RuntimeError("a worker failed:\n" + "\n".join(errors))
+
+    def _observation(self):
+        views = self._views
+        if self.observation_mode == "dict":
+            observation = {key: views[key] for key in
+                           ["area", "playerStatus", "kitchen_meals", "table_status"]}
+            if self.copy:
+                observation = {key: value.copy() for key, value in observation.items()}
+            return observation
+        if self.copy:
+            return views["observation"].copy()
+        return views["observation"]
+
+    def reset(self, *, seed=None, options=None):
+        super().reset(seed=seed)
+        if options is not None and "reset_mask" in options:
+            self._views["reset_mask"][:] = np.asarray(options["reset_mask"], dtype=bool)
+        else:
+            self._views["reset_mask"][:] = True
+        # env i is seeded with seed + i, like the gymnasium vector envs
+        if seed is None:
+            self._views["seeds"][:] = -1
+        else:
+            self._views["seeds"][:] = seed + np.arange(self.num_envs)
+        self._command(RESET)
+        return self._observation(), self._info()
+
+    def step(self, actions):
+        self._views["actions"][:] = actions
+        self._command(STEP)
+        views = self._views
+        return (self._observation(), views["rewards"].copy(), views["terminated"].copy(),
+                views["truncated"].copy(), self._info())
+
+    def _info(self):
+        return {"action_mask": self.action_masks(),
+                "_action_mask": np.ones((self.num_envs,), dtype=bool)}
+
+    def action_masks(self):
+        """
+        (num_envs, 6) bool array of the legal actions of every restaurant
+        """
+        return self._views["action_mask"].copy()
+
+    def close_extras(self, **kwargs):
+        for pipe in self._pipes:
+            try:
+                pipe.send_bytes(CLOSE)
+                pipe.recv_bytes()
+            except (BrokenPipeError, EOFError):
+                pass
+            pipe.close()
+        for process in self._processes:
+            process.join()
@@ -0,0 +1,149 @@
+import numpy as np
+import itertools
+import os
+from time import time
+from table_server.envs.table_server_model import TableServerState, TableServerModel, ActionIndex, TABLE_SPAWNS
+
+
+class TableServerTabularModel:
+    """
+    TableServerModel backend that enumerates every reachable state of the
+    default layout once and answers the model functions with array lookups.
+    States are int ids into the tables, RESULT returns ids and every function
+    also accepts observations and TableServerStates.
+    """
+
+    def __init__(self, cache_path=None):
+        if cache_path is not None and os.path.exists(cache_path):
+            self.load(cache_path)
+        else:
+            self.build()
+            if cache_path is not None:
+                self.save(cache_path)
+
+    def build(self):
+        start_time = time()
+        actions = len(ActionIndex)
+
+        # every start configuration of the default layout
+        frontier = []
+        for kitchen_meals in itertools.permutations([1, 2, 3]):
+            for table_spawns in itertools.permutations(TABLE_SPAWNS.tolist()):
+                frontier.append(TableServerState(
+                    kitchen_meals=kitchen_meals, table_spawns=table_spawns))
+        ids = {}
+        states = []
+        for state in frontier:
+            ids[state.encode()] = len(states)
+            states.append(state)
+
+        # breadth first over the reachable space, ids in discovery order
+        successors = []
+        i = 0
+        while i < len(states):
+            state = states[i]
+            row = []
+            for action in range(actions):
+                state_prime = state.copy()
+                state_prime.turn(action)
+                code = state_prime.encode()
+                if code not in ids:
+                    ids[code] = len(states)
+                    states.append(state_prime)
+                row.append(ids[code])
+            successors.append(row)
+            i += 1
+
+        count = len(states)
+        self.codes = np.array([state.encode()
+                              for state in states], dtype=np.int64)
+        self.successors = np.array(successors, dtype=np.int32)
+        self.legal = np.zeros((count, actions), dtype=bool)
+        self.costs = np.zeros((count, actions), dtype=np.int8)
+        self.goals = np.zeros((count,), dtype=bool)
+        self.heuristics = np.zeros((count,), dtype=np.int16)
+        for state_id, state in enumerate(states):
+            self.legal[state_id, TableServerModel.ACTIONS(state)] = True
+            for action in range(actions):
+                state_prime = states[self.successors[state_id, action]]
+                self.costs[state_id, action] = TableServerModel.STEP_COST(
+                    state, action, state_prime)
+            self.goals[state_id] = TableServerModel.GOAL_TEST(state)
+            self.heuristics[state_id] = TableServerModel.HEURISTIC(state)
+
+        self._ids = ids
+        self.build_time = time() - start_time
+        return self
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez_compressed(f, codes=self.codes, successors=self.successors,
+                                legal=self.legal, costs=self.costs,
+                                goals=self.goals, heuristics=self.heuristics)
+
+    def load(self, path):
+        start_time = time()
+        with np.load(path) as tables:
+            self.codes = tables["codes"]
+            self.successors = tables["successors"]
+            self.legal = tables["legal"]
+            self.costs = tables["costs"]
+            self.goals = tables["goals"]
+            self.heuristics = tables["heuristics"]
+        self._ids = dict(zip(self.codes.tolist(), range(self.codes.size)))
+        self.build_time = time() - start_time
+        return self
+
+    @property
+    def size(self):
+        return self.codes.size
+
+    @property
+    def nbytes(self):
+        return (self.codes.nbytes + self.successors.nbytes + self.legal.nbytes +
+                self.costs.nbytes + self.goals.nbytes + self.heuristics.nbytes)
+
+    def report(self):
+        return "{} states, {:.2f} MB, built in {:.2f} s".format(
+            self.size, self.nbytes / 2**20, self.build_time)
+
+    def STATE_ID(self, state):
+        if isinstance(state, (int, np.integer)):
+            return int(state)
+        return self._ids[TableServerModel.ENCODE(state)]
+
+    def STATE(self, state):
+        return TableServerState.decode(int(self.codes[self.STATE_ID(state)]))
+
+    def ENCODE(self, state):
+        return self.STATE_ID(state)
+
+    def ACTIONS(self, state):
+        return np.flatnonzero(self.legal[self.STATE_ID(state)]).tolist()
+
+    def ACTION_MASK(self, state):
+        return self.legal[self.STATE_ID(state)]
+
+    def ACTION_MASKS(self, states):
+        return self.legal[[self.STATE_ID(state) for state in states]]
+
+    def RESULT(self, state, action):
+        return int(self.successors[self.STATE_ID(state), action])
+
+    def STEP_COST(self, state, action, state_prime):
+        return int(self.costs[self.STATE_ID(state), action])
+
+    def GOAL_TEST(self, state):
+        return bool(self.goals[self.STATE_ID(state)])
+
+    def FIRST_GOAL_TEST(self, state):
+        return TableServerModel.FIRST_GOAL_TEST(self.STATE(state))
+
+    def SECOND_GOAL_TEST(self, state):
+        return TableServerModel.SECOND_GOAL_TEST(self.STATE(state))
+
+    def THIRD_GOAL_TEST(self, state):
+        return TableServerModel.THIRD_GOAL_TEST(self.STATE(state))
+
+    def HEURISTIC(self, state):
+        return int(self.heuristics[self.STATE_ID(state)])
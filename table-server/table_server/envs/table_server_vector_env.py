@@ -0,0 +1,167 @@
+import numpy as np
+from gymnasium import spaces
+from gymnasium.vector import VectorEnv, AutoresetMode
+from gymnasium.vector.utils import batch_space
+from table_server.envs.table_server_model import AreaIndex, PlayerIndex, ActionIndex, get_layout, table_index, area_high
+
+# row and column change of every action, pick up and serve stay in place
+ACTION_MOVES = np.array([[-1, 0], [1, 0], [0, -1], [0, 1], [0, 0], [0, 0]])
+
+
+class TableServerVectorEnv(VectorEnv):
+    """
+    num_envs restaurants on one layout stepped together with array
+    operations. Positions, held meals, kitchen queues and table status are
+    stacked arrays, observations are batched dicts with kitchen_meals padded
+    with 0 to a fixed length. Finished restaurants reset on the next step.
+    """
+
+    metadata = {"autoreset_mode": AutoresetMode.NEXT_STEP}
+
+    def __init__(self, num_envs=1, max_episode_steps=80, render_mode=None,
+                 height=5, width=7, tables=3, meals=3, layout_seed=None, **kwargs):
+        if meals > tables:
+            raise ValueError("every meal goes to its own table, {} meals is more than {} tables".format(
+                meals, tables))
+        self.num_envs = num_envs
+        self.max_episode_steps = max_episode_steps
+        self.render_mode = render_mode
+
+        # static layout
+        self.layout = get_layout(height, width, tables, layout_seed)
+        self.height, self.width = height, width
+        self.tables, self.meals = tables, meals
+        self._start_pos = np.array(self.layout.server_spawn)
+        self._kitchen_pos = np.array(self.layout.kitchen_pos)
+        self._base_area = self.layout.base_area
+        self._table_values = np.array(
+            [table_index(table) for table in range(tables)], dtype=np.int32)
+
+        # walls with a border of walls, so moves need no bounds checks
+        self._blocked = np.ones(
+            (self.height + 2, self.width + 2), dtype=bool)
+        self._blocked[1:-1, 1:-1] = self.layout.walls
+
+        self.single_action_space = spaces.Discrete(len(ActionIndex))
+        self.single_observation_space = spaces.Dict(
+            {
+                "area": spaces.Box(low=0, high=area_high(tables), shape=(self.height, self.width), dtype=np.int32),
+                "playerStatus": spaces.Discrete(tables + 1),
+                "kitchen_meals": spaces.Box(low=0, high=tables, shape=(self.meals,), dtype=np.int32),
+                "table_status": spaces.Box(low=0, high=1, shape=(self.tables,), dtype=np.int32),
+            }
+        )
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.observation_space = batch_space(
+            self.single_observation_space, num_envs)
+
+        self._pos = np.zeros((num_envs, 2), dtype=np.int64)
+        self._held = np.zeros((num_envs,), dtype=np.int32)
+        # kitchen queue with meals zero padded on the right, head is the next meal
+        self._kitchen = np.zeros((num_envs, 2 * self.meals), dtype=np.int32)
+        self._kitchen_head = np.zeros((num_envs,), dtype=np.int64)
+        self._table_spawns = np.zeros(
+            (num_envs, self.tables, 2), dtype=np.int64)
+        self._table_status = np.zeros(
+            (num_envs, self.tables), dtype=np.int32)
+        self._steps = np.zeros((num_envs,), dtype=np.int64)
+        self._autoreset = np.zeros((num_envs,), dtype=bool)
+        self._env_ids = np.arange(num_envs)
+
+    def _reset_envs(self, mask):
+        count = int(mask.sum())
+        if count == 0:
+            return
+        self._pos[mask] = self._start_pos
+        self._held[mask] = PlayerIndex.NONE
+        self._kitchen_head[mask] = 0
+        self._steps[mask] = 0
+
+        # one random permutation per restaurant, the first meals tables order
+        meal_order = np.argsort(self.np_random.random(
+            (count, self.tables)), axis=1)[:, :self.meals]
+        table_order = np.argsort(self.np_random.random(
+            (count, self.tables)), axis=1)
+        kitchen = np.zeros((count, 2 * self.meals), dtype=np.int32)
+        kitchen[:, :self.meals] = meal_order + 1
+        self._kitchen[mask] = kitchen
+        self._table_spawns[mask] = self.layout.table_spawns[table_order]
+
+        # tables that ordered nothing count as served
+        table_status = np.ones((count, self.tables), dtype=np.int32)
+        table_status[np.arange(count)[:, None], meal_order] = 0
+        self._table_status[mask] = table_status
+
+    def _observation(self):
+        area = np.broadcast_to(
+            self._base_area, (self.num_envs, self.height, self.width)).copy()
+        for table in range(self.tables):
+            area[self._env_ids, self._table_spawns[:, table, 0],
+                 self._table_spawns[:, table, 1]] = self._table_values[table]
+        area[self._env_ids, self._pos[:, 0], self._pos[:, 1]] = AreaIndex.SERVER
+
+        queue = self._kitchen_head[:, None] + np.arange(self.meals)
+        return {
+            "area": area,
+            "playerStatus": self._held.copy(),
+            "kitchen_meals": self._kitchen[self._env_ids[:, None], queue],
+            "table_status": self._table_status.copy(),
+        }
+
+    def reset(self, *, seed=None, options=None):
+        super().reset(seed=seed)
+        if options is not None and "reset_mask" in options:
+            mask = np.asarray(options["reset_mask"], dtype=bool)
+        else:
+            mask = np.ones((self.num_envs,), dtype=bool)
+        self._reset_envs(mask)
+        self._autoreset[mask] = False
+        return self._observation(), self._info()
+
+    def step(self, actions):
+        actions = np.asarray(actions, dtype=np.int64)
+        resetting = self._autoreset.copy()
+        self._reset_envs(resetting)
+        acting = ~resetting
+
+        # move unless the target is a wall or off the map
+        target = self._pos + ACTION_MOVES[actions]
+        moved = acting & ~self._blocked[target[:, 0] + 1, target[:, 1] + 1]
+        self._pos[moved] = target[moved]
+
+        at_kitchen = (self._pos == self._kitchen_pos).all(axis=1)
+        pick_up = (acting & (actions == ActionIndex.PICK_UP_MEAL) & at_kitchen &
+                   (self._held == PlayerIndex.NONE) & (self._kitchen_head < self.meals))
+        self._held[pick_up] = self._kitchen[pick_up,
+                                            self._kitchen_head[pick_up]]
+        self._kitchen_head[pick_up] += 1
+
+        # serving is only possible at the table of the held meal
+        held_table = np.maximum(self._held - 1, 0)
+        at_table = (self._table_spawns[self._env_ids, held_table]
+                    == self._pos).all(axis=1)
+        serve = (acting & (actions == ActionIndex.SERVE_MEAL) &
+                 (self._held != PlayerIndex.NONE) & at_table)
+        self._table_status[serve, held_table[serve]] = 1
+        self._held[serve] = PlayerIndex.NONE
+
+        rewards = np.where(acting & ~serve, 1, 0).astype(np.int64)
+        terminated = (acting & self._table_status.all(axis=1) &
+                      (self._kitchen_head == self.meals) & (self._held == PlayerIndex.NONE))
+        self._steps[acting] += 1
+        truncated = acting & ~terminated & (
+            self._steps >= self.max_episode_steps)
+        self._autoreset = terminated | truncated
+
+        return self._observation(), rewards, terminated, truncated, self._info()
+
+    def _info(self):
+        return {"action_mask": self.action_masks(),
+                "_action_mask": np.ones((self.num_envs,), dtype=bool)}
+
+    def action_masks(self):
+        """
+        (num_envs, 6) bool array of the legal actions of every restaurant
+        """
+        return self.layout.action_masks[self._pos[:, 0], self._pos[:, 1],
+                                        (self._held != PlayerIndex.NONE).astype(np.int64)]